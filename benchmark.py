@@ -0,0 +1,338 @@
+# Python
+import sys
+import gc
+import math
+import bisect
+import time
+import random
+import logging
+import tracemalloc
+
+# 3rd Party
+
+# Self
+from dedup_set import dedup_set_t
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+'''
+Benchmarks for the bot's data structures and API usage.
+
+usage:
+	python benchmark.py dedup [n ...]
+	python benchmark.py refresh [comment id ...]
+	python benchmark.py intervals [state db]
+
+dedup runs offline. refresh logs in with settings_secret.json and compares
+the two ways of refreshing maintained comments, by default for the first
+entries in save/state.db. intervals replays the edits and deletions recorded
+in the state db against the fixed check curve and the learned intervals. Only
+a sample of replies has its observations recorded, see evaluation_sample in
+settings.json.
+'''
+
+# roughly where reddit's base36 comment IDs are at the moment
+ID_BASE = int('k000000', 36)
+# the backlog window, matches backlog_time_limit in settings.json
+WINDOW = 259200
+
+def to_base36(n):
+	chars = '0123456789abcdefghijklmnopqrstuvwxyz'
+	s = ''
+
+	while n > 0:
+		n, r = divmod(n, 36)
+		s = chars[r] + s
+
+	return s
+
+def measure(build):
+	gc.collect()
+	tracemalloc.start()
+	obj = build()
+	size, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	return obj, size
+
+def time_lookups(contains, ids):
+	start = time.perf_counter()
+
+	for id in ids:
+		contains(id)
+
+	return (time.perf_counter() - start) / len(ids) * 1e9
+
+def bench_dedup(n):
+	ids = [to_base36(ID_BASE + i) for i in range(n)]
+	# spread the IDs evenly over the backlog window, as the stream would
+	step = WINDOW / n
+	now = time.time() - WINDOW
+
+	hits = random.sample(ids, min(n, 100000))
+	misses = [to_base36(ID_BASE + n + i) for i in range(len(hits))]
+
+	def build_dict():
+		# the stream keeps the ID strings alive as dict keys, so build fresh
+		# ones here for them to count towards the dict's footprint
+		d = {}
+
+		for i in range(n):
+			d[to_base36(ID_BASE + i)] = True
+
+		return d
+
+	def build_dedup(bloom):
+		def build():
+			s = dedup_set_t(WINDOW, bloom=bloom)
+
+			for i, id in enumerate(ids):
+				s.add(id, now=now + i * step)
+
+			return s
+
+		return build
+
+	logging.info("n={}".format(n))
+	logging.info("structure\tmemory\thit\tmiss")
+
+	d, size = measure(build_dict)
+	logging.info("dict\t{:.1f}MB\t{:.0f}ns\t{:.0f}ns".format(
+		size / 1e6,
+		time_lookups(d.__contains__, hits),
+		time_lookups(d.__contains__, misses)))
+	del d
+
+	for bloom in (False, True):
+		s, size = measure(build_dedup(bloom))
+		last = now + n * step
+		contains = lambda id, s=s: s.contains(id, now=last)
+		logging.info("dedup{}\t{:.1f}MB\t{:.0f}ns\t{:.0f}ns".format(
+			'+bloom' if bloom else '',
+			size / 1e6,
+			time_lookups(contains, hits),
+			time_lookups(contains, misses)))
+		del s
+
+class traffic_counter_t:
+	'''
+	Response hook for the requests session PRAW uses, adds up the requests,
+	bytes (after decompression) and time of every response.
+	'''
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.requests = 0
+		self.bytes = 0
+		self.seconds = 0
+
+	def __call__(self, response, *args, **kwargs):
+		self.requests += 1
+		self.bytes += len(response.content)
+		self.seconds += response.elapsed.total_seconds()
+
+def bench_refresh(ids):
+	# 3rd Party
+	import praw
+	import requests
+
+	# Self
+	from config import config_helper as config
+	config.set_mode('debug')
+	from state_store import state_store_t
+	from info_source import reddit_info_source_t
+
+	counter = traffic_counter_t()
+	session = requests.Session()
+	session.hooks['response'].append(counter)
+
+	reddit = praw.Reddit(username = config.username,
+		password = config.password,
+		client_id = config.client_id,
+		client_secret = config.client_secret,
+		user_agent = "linux:PoBPreviewBot:benchmark (by /u/aggixx)",
+		requestor_kwargs = {'session': session})
+
+	if len(ids) == 0:
+		store = state_store_t("save/state.db")
+		ids = [row[0] for row in store.execute("SELECT comment_id FROM maintain_list LIMIT 20")]
+
+	if len(ids) == 0:
+		logging.info("No comments to benchmark.")
+		return
+
+	# Set up the objects the way maintenance holds on to them, so only the
+	# refreshes themselves are measured
+	pairs = []
+
+	for id in ids:
+		comment = praw.models.Comment(reddit, id=id)
+		comment._fetch()
+		pairs.append((comment, comment.parent()))
+
+	def refresh_objects():
+		# what entry_t.refresh used to do
+		for comment, parent in pairs:
+			comment.refresh()
+
+			if isinstance(parent, praw.models.Comment):
+				parent.refresh()
+			else:
+				parent._fetch()
+
+	def refresh_info():
+		info = reddit_info_source_t(reddit)
+
+		for comment, parent in pairs:
+			info.fetch([comment.fullname, parent.fullname])
+
+	logging.info("n={}".format(len(pairs)))
+	logging.info("method\trequests\tbytes\tlatency (per entry)")
+
+	for name, func in (('refresh', refresh_objects), ('info', refresh_info)):
+		counter.reset()
+		func()
+
+		logging.info("{}\t{:.1f}\t{:.1f}KB\t{:.0f}ms".format(
+			name,
+			counter.requests / len(pairs),
+			counter.bytes / len(pairs) / 1e3,
+			counter.seconds / len(pairs) * 1e3))
+
+# Replays a policy's checks over a comment's recorded life. Returns the number
+# of checks, the delay before each change was noticed, and the number of
+# changes no check came after.
+def simulate(get_interval, timeline):
+	horizon, changes, subreddit, author = timeline
+	checks = []
+	age = 0
+
+	while True:
+		age += get_interval(age, subreddit, author)
+
+		if age > horizon:
+			break
+
+		checks.append(age)
+
+	delays = []
+	missed = 0
+
+	for change in changes:
+		i = bisect.bisect_left(checks, change)
+
+		if i < len(checks):
+			delays.append(checks[i] - change)
+		else:
+			missed += 1
+
+	return len(checks), delays, missed
+
+def evaluate(get_interval, timelines):
+	checks = 0
+	delays = []
+	missed = 0
+
+	for timeline in timelines:
+		c, d, m = simulate(get_interval, timeline)
+		checks += c
+		delays += d
+		missed += m
+
+	return checks, sorted(delays), missed
+
+def bench_intervals(path):
+	# Self
+	from config import config_helper as config
+	config.set_mode('debug')
+	from state_store import state_store_t
+	import maintenance_model
+	from maintenance_model import hazard_model_t
+	from comment_maintenance import entry_t
+
+	store = state_store_t(path)
+	rows = store.execute("SELECT comment_id, subreddit, author, from_age, to_age, kind, event_age FROM maintain_events").fetchall()
+
+	if len(rows) == 0:
+		logging.info("No maintenance events recorded in {}.".format(path))
+		return
+
+	# fit on half the comments, evaluate on the other half
+	train = []
+	test = {}
+
+	for comment_id, subreddit, author, from_age, to_age, kind, event_age in rows:
+		if int(comment_id, 36) % 2 == 0:
+			train.append((subreddit, author, from_age, to_age, kind, event_age))
+			continue
+
+		if comment_id not in test:
+			test[comment_id] = [0, [], subreddit, author]
+
+		timeline = test[comment_id]
+		timeline[0] = max(timeline[0], to_age)
+
+		if kind != 'none':
+			timeline[1].append(event_age)
+
+	timelines = [tuple(timeline) for timeline in test.values()]
+
+	model = hazard_model_t(config.maintenance_model)
+	model.fit([key + tuple(value) for key, value in maintenance_model.count(train).items()])
+
+	# no jitter, both policies are replayed exactly
+	config.settings['deletion_check_interval_rng'] = 0
+
+	def curve(age, subreddit, author):
+		return entry_t.get_check_time(age)
+
+	def learned(target):
+		return lambda age, subreddit, author: model.get_interval(age, subreddit, author, target=target)
+
+	results = [('curve', evaluate(curve, timelines))]
+	results.append(('model', evaluate(learned(None), timelines)))
+
+	# the target that spends as many requests as the curve, so the latencies
+	# can be compared at equal cost
+	budget = results[0][1][0]
+	lo, hi = 1e-6, 10.0
+
+	for i in range(40):
+		target = math.sqrt(lo * hi)
+
+		if evaluate(learned(target), timelines)[0] > budget:
+			lo = target
+		else:
+			hi = target
+
+	results.append(('model@{:.4f}'.format(hi), evaluate(learned(hi), timelines)))
+
+	changes = sum(len(timeline[1]) for timeline in timelines)
+
+	logging.info("{}, trained on {} observations, {} comments and {} changes to test on".format(model, len(train), len(timelines), changes))
+	logging.info("policy\tchecks/comment\tmean delay\tp90 delay\tmissed")
+
+	for name, (checks, delays, missed) in results:
+		logging.info("{}\t{:.1f}\t{:.0f}s\t{:.0f}s\t{}".format(
+			name,
+			checks / len(timelines),
+			sum(delays) / len(delays) if len(delays) > 0 else 0,
+			delays[int(len(delays) * 0.9)] if len(delays) > 0 else 0,
+			missed))
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] not in ('dedup', 'refresh', 'intervals'):
+		print("usage: python benchmark.py dedup [n ...]")
+		print("       python benchmark.py refresh [comment id ...]")
+		print("       python benchmark.py intervals [state db]")
+		sys.exit(1)
+
+	if sys.argv[1] == 'dedup':
+		for n in [int(x) for x in sys.argv[2:]] or [1000000, 10000000]:
+			bench_dedup(n)
+	elif sys.argv[1] == 'refresh':
+		bench_refresh(sys.argv[2:])
+	else:
+		bench_intervals(sys.argv[2] if len(sys.argv) > 2 else "save/state.db")
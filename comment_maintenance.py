@@ -9,13 +9,16 @@ import datetime
 import json
 import logging
 import copy
+import heapq
+import hashlib
+import zlib
+import difflib
+import concurrent.futures
 
 # 3rd Party
-import praw
 import urllib.request, urllib.error, urllib.parse
 from retrying import retry
 #from pympler import asizeof
-from atomicwrites import atomic_write
 
 from prawcore.exceptions import Forbidden
 from praw.exceptions import APIException
@@ -25,7 +28,12 @@ import util
 import logger
 from config import config_helper as config
 import official_forum
+import importers
 from praw_wrapper import praw_object_wrapper_t
+import info_source
+from info_source import reddit_info_source_t
+import maintenance_model
+from maintenance_model import hazard_model_t
 
 from _exceptions import ImporterLimitException
 from _exceptions import EligibilityException
@@ -34,16 +42,6 @@ from _exceptions import EligibilityException
 
 not_author_blacklist = {};
 
-class entry_encoder_t(json.JSONEncoder):
-	def default(self, obj):
-		if isinstance(obj, entry_t):
-			return {
-				'comment_id': obj.comment_id,
-				'created_utc': int(obj.created_utc),
-				'last_time': int(obj.last_time),
-			}
-		return json.JSONEncoder.default(self, obj)
-		
 class entry_t:
 	def __init__(self, list, jdict):
 		self.list = list
@@ -54,6 +52,23 @@ class entry_t:
 		self.comment = None
 		self.parent = None
 		
+		# fullname of the comment or submission replied to, learned the
+		# first time the reply is fetched if not known up front
+		if not hasattr(self, 'parent_id'):
+			self.parent_id = None
+			
+		# hash of what the reply was last rendered from, see get_fingerprint()
+		if not hasattr(self, 'fingerprint'):
+			self.fingerprint = None
+			
+		# hash of the reply's body as last posted or edited, see set_shadow()
+		if not hasattr(self, 'body_hash'):
+			self.body_hash = None
+			
+		# the parent's subreddit and author, learned on the first check
+		self.subreddit = None
+		self.author = None
+		
 		if not hasattr(self, 'time'):
 			#logging.warning("Entry {} initialized without 'time' attribute!".format(self.comment_id))
 			self.update_check_time()
@@ -66,6 +81,16 @@ class entry_t:
 			#logging.warning("Entry {} initialized without 'retired' attribute!".format(self.comment_id))
 			self.retired = self.get_age() >= config.preserve_comments_after
 			
+	# the persisted part of the entry
+	def to_dict(self):
+		return {
+			'comment_id': self.comment_id,
+			'created_utc': int(self.created_utc),
+			'last_time': int(self.last_time),
+			'parent_id': self.parent_id,
+			'fingerprint': self.fingerprint,
+		}
+			
 	def asizeof(self):
 		b = 0
 		
@@ -86,30 +111,15 @@ class entry_t:
 	def __str__(self):
 		return "entry {}".format(self.comment_id)
 			
-	@retry(retry_on_exception=util.is_praw_error,
-		   wait_exponential_multiplier=config.praw_error_wait_time,
-		   wait_func=util.praw_error_retry)
 	def get_comment(self):
 		if self.comment is None:
-			comment = util.get_praw_comment_by_id(self.list.reddit, self.comment_id)
-			self.comment = praw_object_wrapper_t(self.bot, comment)
-		
-			# Fetch the comment now in a place where RequestExceptions can be handled properly.
-			if not self.comment._fetched:
-				self.comment._fetch()
+			self.refresh()
 			
 		return self.comment
 			
-	@retry(retry_on_exception=util.is_praw_error,
-		   wait_exponential_multiplier=config.praw_error_wait_time,
-		   wait_func=util.praw_error_retry)
 	def get_parent(self):
 		if self.parent is None:
-			self.parent = self.get_comment().parent()
-		
-			# Fetch the comment now in a place where RequestExceptions can be handled properly.
-			if not self.parent._fetched:
-				self.parent._fetch()
+			self.refresh()
 			
 		return self.parent
 	
@@ -136,6 +146,10 @@ class entry_t:
 			# 4.585+ weeks: 72 hrs
 			t *= min( math.pow( 2, ( comment_age - 604800 ) / 604800 ), 12 )
 			
+		return entry_t.jitter(t)
+		
+	@staticmethod
+	def jitter(t):
 		if config.deletion_check_interval_rng > 0:
 			t *= 1.0 + config.deletion_check_interval_rng * ( 2.0 * random.random() - 1.0 )
 			
@@ -144,49 +158,32 @@ class entry_t:
 	def get_age(self):
 		return time.time() - self.created_utc
 		
+	# Uses the learned intervals once there's enough data for them, see
+	# maintenance_model.py
+	def get_interval(self):
+		model = self.list.model
+		
+		if not model.is_ready():
+			return entry_t.get_check_time(self.get_age())
+			
+		return entry_t.jitter(model.get_interval(self.get_age(), self.subreddit, self.author))
+		
 	def update_check_time(self):
-		self.time = time.time() + entry_t.get_check_time(self.get_age())
+		self.time = time.time() + self.get_interval()
 		
 	def flag(self):
 		self.time = 0
 		
-	@retry(retry_on_exception=util.is_praw_error,
-		   wait_exponential_multiplier=config.praw_error_wait_time,
-		   wait_func=util.praw_error_retry)	
-	def __refresh__(self, object):
-		try:
-			if isinstance(object, praw.models.Comment):
-				object.refresh()
-			else:
-				# There doesn't seem to be a way to refresh a submission, so we
-				# have to use the internal function "fetch"
-				object._fetch()
-		except praw.exceptions.ClientException as e:
-			# Dump info
-			logging.warning("ClientException occurred when refreshing for maintenance of comment {}".format(self.comment_id))
-			util.dump_debug_info(object, exc=e, extra_data={
-				'entry_t': json.dumps(self.__dict__),
-			})
-			
-			# Reraise the exception so refresh() knows we failed
-			raise e
-		
+	# Fetches the reply and its parent through /api/info. Comment.refresh()
+	# would also pull the reply's reply tree, and fetching a submission pulls
+	# its whole comment page, none of which maintenance looks at.
 	def refresh(self):
-		try:
-			if self.comment is not None:
-				self.__refresh__(self.comment)
-				
-			if self.parent is not None:
-				self.__refresh__(self.parent)
-		except praw.exceptions.ClientException:
-			return False
-			
-		return True
+		return self in self.list.refresh_batch([self])
 	
 	@retry(retry_on_exception=util.is_praw_error,
 		   wait_exponential_multiplier=config.praw_error_wait_time,
 		   wait_func=util.praw_error_retry)	
-	def maintain(self):
+	def maintain(self, refreshed=False):
 		# Whether the comment has been deleted, and therefore doesn't need to
 		# be maintained anymore.
 		deleted = False
@@ -198,9 +195,9 @@ class entry_t:
 		else:
 			logging.debug("Maintaining comment {:s}.".format( self.comment_id ))
 			
-			# if we've already made a comment object, then
-			# force refresh on the comment, otherwise we won't be able to detect any changes
-			if self.refresh():
+			# fetch fresh copies of the reply and parent, unless a batch
+			# refresh just did
+			if refreshed or self.refresh():
 				# Make sure the reply has not already been deleted
 				if self.get_comment().body == "[deleted]":
 					logging.warning("Reply {} has already been deleted, removing from list of active comments.".format(self.comment_id))
@@ -209,6 +206,7 @@ class entry_t:
 				try:
 					if not deleted:
 						deleted = self.check_for_deletion()
+						self.record(deleted)
 
 					if not deleted:
 						deleted = self.check_for_edit()
@@ -241,6 +239,8 @@ class entry_t:
 				self.list.add_entry(self)	
 			else:
 				self.retire()
+		else:
+			self.list.drop(self)
 				
 		# free memory if this entry isn't going to be visited very soon
 		# we have to fetch new data anyway so keeping the old object around
@@ -250,15 +250,62 @@ class entry_t:
 			self.comment = None
 			self.parent = None
 				
+	# Records what this check saw of the parent for the interval model
+	def record(self, deleted):
+		parent = self.get_parent()
+		
+		self.subreddit = str(parent.subreddit).lower()
+		self.author = str(parent.author).lower() if parent.author is not None else None
+		
+		# ages are the reply's, as in get_check_time
+		from_age = max(self.last_time - self.created_utc, 0)
+		to_age = self.get_age()
+		
+		kind = 'none'
+		event_age = None
+		
+		if deleted:
+			kind = 'delete'
+			event_age = to_age
+		elif isinstance(parent.edited, float) and parent.edited > max(self.last_time, self.created_utc):
+			kind = 'edit'
+			event_age = parent.edited - self.created_utc
+			
+		self.list.record( (time.time(), self.comment_id, self.subreddit, self.author, from_age, to_age, kind, event_age) )
+		
 	def retire(self):
 		self.retired = True
-		self.list.retired_list.append(self)
+		self.list.archive(self)
+			
+	def is_root(self):
+		if self.parent_id is not None:
+			return self.parent_id.startswith('t3_')
 			
+		return self.get_comment().is_root
+		
+	@staticmethod
+	def hash_body(body):
+		return hashlib.sha1(body.encode('utf-8')).hexdigest()
+		
+	# Keeps a copy of the reply's body as posted or edited, so edits can be
+	# diffed without fetching the reply
+	def set_shadow(self, body):
+		self.body_hash = entry_t.hash_body(body)
+		self.list.shadow(self.comment_id, self.body_hash, body)
+		
+	# Whether body is what the reply already says. Entries from before
+	# shadows were kept take theirs from the reply the first time.
+	def is_posted(self, body):
+		if self.body_hash is None:
+			self.set_shadow(self.get_comment().body)
+			
+		return entry_t.hash_body(body) == self.body_hash
+		
 	def check_for_deletion(self):
 		comment = self.get_comment()
 		parent = self.get_parent()
 		
-		if comment.is_root:
+		if self.is_root():
 			if parent.selftext == "[deleted]" or parent.selftext == "[removed]":
 				comment.delete()
 				logging.info("Deleted comment {:s} as parent submission {:s} was deleted.".format( self.comment_id, parent.id ))
@@ -278,12 +325,19 @@ class entry_t:
 		   wait_func=util.praw_error_retry)	
 	def check_for_edit(self):
 		parent = self.get_parent()
-		comment = self.get_comment()
 		
 		# has the comment been edited recently OR the comment is new (edit tag is not visible so we need to check to be safe)
 		# grace period is apparently 180 seconds, but lets check for a bit longer to be safe
 		
-		if ( isinstance(parent.edited, float) and parent.edited >= self.last_time - 10 ) or time.time() - parent.created_utc < 400 or ( comment.is_root and parent.selftext == '' and official_forum.is_post( parent.url ) ) or self.time == 0:
+		if ( isinstance(parent.edited, float) and parent.edited >= self.last_time - 10 ) or time.time() - parent.created_utc < 400 or ( self.is_root() and parent.selftext == '' and official_forum.is_post( parent.url ) ) or self.time == 0:
+			fingerprint = entry_t.get_fingerprint(parent)
+			
+			# the render only depends on what's fingerprinted, flagged
+			# entries are rendered regardless
+			if fingerprint == self.fingerprint and self.time != 0:
+				logging.debug("{:s} is unchanged since it was last rendered.".format(parent.id))
+				return False
+				
 			new_comment_body = None
 			
 			try:
@@ -292,17 +346,25 @@ class entry_t:
 				print(e)
 			
 			if new_comment_body is None:
-				comment.delete()
+				self.get_comment().delete()
 				logging.info("Parent {:s} no longer links to any builds, deleted response comment {:s}.".format(parent.id, self.comment_id))
 				
 				if self.list.replied_to.contains(parent.id):
 					self.list.replied_to.remove(parent)
 					
 				return True
-			elif new_comment_body != comment.body:
+			elif not self.is_posted(new_comment_body):
 				try:
-					comment.edit(new_comment_body)
+					old_comment_body = self.list.get_shadow(self.comment_id)
+					self.get_comment().edit(new_comment_body)
+					self.set_shadow(new_comment_body)
+					# only once the reply says what was rendered, a failed
+					# edit is retried
+					self.fingerprint = fingerprint
 					logging.info("Edited comment {:s} to reflect changes in parent {:s}.".format(self.comment_id, parent.id))
+					
+					if old_comment_body is not None:
+						logging.debug("\n".join(difflib.unified_diff(old_comment_body.splitlines(), new_comment_body.splitlines(), lineterm='', n=0)))
 				except APIException as e:
 					if "NOT_AUTHOR" in str(e):
 						logging.warning("Attempted to modify comment {} that we do not own. Ignoring for the remainder of this execution.".format(self.comment_id))
@@ -310,6 +372,7 @@ class entry_t:
 					else:
 						raise e
 			else:
+				self.fingerprint = fingerprint
 				logging.debug("{:s}'s response body is unchanged.".format(parent.id))
 		else:
 			if isinstance(parent.edited, float):
@@ -322,6 +385,28 @@ class entry_t:
 				
 		return False
 		
+	# Hash of everything a response is rendered from: the parent's body, the
+	# importers found in it and its author. Pastes are immutable, so as long
+	# as it's unchanged so is the response.
+	@staticmethod
+	def get_fingerprint(parent):
+		body = parent.get_body()
+		keys = ["{}:{}".format(type(importer).__name__, importer.key) for importer in importers.find_importers(body)]
+		
+		h = hashlib.sha1()
+		
+		for part in [body, str(parent.get_author())] + keys:
+			h.update(part.encode('utf-8'))
+			h.update(b'\0')
+			
+		return h.hexdigest()
+		
+	# Time the entry is next due for maintenance. praw caches content for 30
+	# seconds so there is no point in checking an entry more often than every
+	# 35 seconds.
+	def get_due(self):
+		return max(self.time, self.last_time + 35)
+		
 	# Returns a float that represents the percentage of time that has elapsed
 	# towards the next maintainance
 	def get_progress(self):
@@ -337,116 +422,60 @@ class entry_t:
 		return elapsed / dur
 		
 class aggressive_maintainer_t(threading.Thread):
-	rate_limit_window = 600
-	
 	def __init__(self, list):
 		threading.Thread.__init__(self, name='ACMThread')
 		
 		self.list = list
 		self.bot = list.bot
-		# the max amount of the rate limit to utilize.
-		# ie: 0.80 means we stop maintaining more comments once we reach 80%
-		# utilized of the max query amount
-		self.amu = config.aggressive_maintenance_utilization
+		# maintenance gets whatever the rate budget has left over, see
+		# rate_budget.py
+		self.budget = list.bot.budget
+		
+		# Batches are maintained on a pool of workers, so maintenance isn't
+		# bound by the round trip time of one batch at a time. The number of
+		# batches running at once is adapted, see get_limit().
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(config.acm_workers, 1), thread_name_prefix='ACMWorker')
+		self.running = 0
+		self.slots = threading.Condition()
+		# smoothed seconds a batch takes to maintain, None until one has
+		self.batch_time = None
 		
 		logging.debug("Created ACM daemon thread.")
-	
-	# Get Rate Limit utilization
-	# Returns a percent (float) that represents the projected number of queries
-	# relative to the maximum number of queries for the current rate limit
-	# period. For example:
-	# 0.50 would mean that its projected that only half the max queries will be used
-	# 1.50 would mean that its projected that we will exceed the max queries and get throttled
-	def get_rl_utilization(self):
-		rl = self.bot.reddit._core._rate_limiter
-		
-		# rate limit window end timestamp
-		end = rl.reset_timestamp
-		# rate limit window start timestamp (assumed)
-		start = end - self.rate_limit_window
-		# elapsed time
-		elapsed = time.time() - start
-		elapsed_pct = elapsed / self.rate_limit_window
-		
-		if elapsed_pct == 0:
-			return 1.0
-		
-		queries_total = rl.used + rl.remaining
-		
-		if queries_total == 0:
-			return 1.0
 		
-		used_pct = rl.used / queries_total
-		
-		'''
-		logging.debug("PRAW rate limit utilization: used={:.0f} rem={:.0f} total={:.0f} start={:.3f} end={:.3f} elapsed={:.3f} el_pct={:.2f}% used_pct={:.2f}% util={:.2f}%".format(
-			rl.used, rl.remaining, queries_total,
-			start, end, elapsed,
-			elapsed_pct*100, used_pct*100, used_pct / elapsed_pct * 100 ) )
-		'''
-		
-		return used_pct / elapsed_pct
-		
-	def sleep(self):
-		rl = self.bot.reddit._core._rate_limiter
+	# Requests a full batch takes to refresh, reserved before the batch is
+	# chosen. Anything a batch spends on top (edits, second rounds) is
+	# accounted for by the budget through the response headers.
+	def get_batch_cost(self):
+		if config.maintenance_batch_size > 1:
+			return math.ceil(2 * config.maintenance_batch_size / info_source.BATCH_SIZE)
+			
+		return 1
 		
-		# rate limit window end timestamp
-		end = rl.reset_timestamp
-
-		# rate limit window start timestamp (assumed)
-		start = end - self.rate_limit_window
+	# Batches to keep running at once. By Little's law that's the rate of
+	# batches the budget allows times how long a batch takes, anything more
+	# would only queue up in the budget.
+	def get_limit(self):
+		workers = max(config.acm_workers, 1)
 		
-		queries_total = rl.used + rl.remaining
-		used_pct = rl.used / queries_total
-
-		dur = 0
-
-		if time.time() >= end and used_pct >= self.amu:
-			# sometimes the RL cycle last longer than its stated duration.
-			# if that happens and we've used what we can, then sleep til the cycle ends
-			# otherwise we'll end up looping through main as fast as possible and wasting a lot of CPU cycles
-			# since we don't know when the cycle will actually end, just sleep in 100ms increments
-			dur = 0.100
-		else:
-			ready_time = start + self.rate_limit_window * min( 1.0, used_pct / self.amu )
+		if self.batch_time is None:
+			return 1
 			
-			# add 10ms to avoid rounding issues causing excessive cycles
-			dur = ready_time - time.time() + 0.010
+		batches = self.budget.get_rate() / self.get_batch_cost()
 		
-		if dur > 0.000:
-			logging.debug("ACMThread idling for {:.3f}s.".format(dur))
-			time.sleep(dur)
-			
-	def wait_for_init(self):
-		rl = self.bot.reddit._core._rate_limiter
+		return min(max(math.ceil(batches * self.batch_time), 1), workers)
 		
-		while rl.remaining is None or rl.used is None or rl.reset_timestamp is None:
-			time.sleep(1)
-			
+	# Takes the entries that are due soonest out of the list, as many as are
+	# maintained together, see maintain_list_t.refresh_batch()
 	def choose(self):
-		val = -1
-		highest = None
-		
-		# filter to entries that haven't been checked in at least 35 seconds
-		# praw caches content for 30 seconds so there is literally no point in
-		# doing it more often than that
-		now = time.time()
+		entries = self.list.pop_batch(time.time(), max(config.maintenance_batch_size, 1))
 		
-		for entry in [e for e in self.list.list if now - e.last_time >= 35]: 
-			prog = entry.get_progress()
-			
-			if prog > val:
-				val = prog
-				highest = entry
+		if len(entries) > 0:
+			val = entries[0].get_progress()
+			logging.debug("Highest entry is {} at {:.2f}% progress. Current ACM rate is {:.2f}x.".format(entries[0], val*100, 1/val if val > 0 else 0))
 				
-		logging.debug("Highest entry is {} at {:.2f}% progress. Current ACM rate is {:.2f}x.".format(highest, val*100, 1/val))
-				
-		return highest
+		return entries
 		
 	def main(self):
-		# Wait for the rate limiter to initialize
-		self.wait_for_init()
-		
 		logging.debug("ACM has initialized.")
 		
 		while True:
@@ -455,35 +484,112 @@ class aggressive_maintainer_t(threading.Thread):
 			# If main thread is awake, it will return as soon as it goes to sleep.
 			self.bot.acm_event.wait()
 			
-			while self.get_rl_utilization() < self.amu and len(self.list) > 0:
-				self.list.lock.acquire()
-
-				# choose the entry we will maintain
-				entry = self.choose()
+			# wait for a batch to finish if as many are running as should be
+			with self.slots:
+				while self.running >= self.get_limit():
+					self.slots.wait()
+			
+			# sleep until an entry can be maintained, or a new one is added
+			self.list.pushed.clear()
+			next_time = self.list.get_next_time()
+			
+			if next_time is None or next_time > time.time():
+				dur = next_time - time.time() if next_time is not None else None
+				logging.debug("ACMThread idling for {}.".format("{:.3f}s".format(dur) if dur is not None else "a new entry"))
+				self.list.pushed.wait(dur)
+				continue
+				
+			# wait for the budget to allow a batch
+			cost = self.get_batch_cost()
+			self.budget.acquire('maintenance', cost)
+			
+			# The lock is only held to take entries out of the list, the
+			# fetches, renders and edits happen without it. Entries are out of
+			# the list until maintain() pushes them back.
+			with self.list.lock:
+				# choose the entries we will maintain
+				entries = self.choose()
 
-				if not entry:
-					# there are no entries to maintain
-					self.list.lock.release()
-					# sleep to avoid spinlock
-					time.sleep(0.100)
-					break
+			if len(entries) == 0:
+				# taken in the meantime
+				self.budget.refund(cost)
+				continue
 				
-				self.list.list.remove(entry)
+			with self.slots:
+				self.running += 1
 				
-				entry.maintain()
-
-				self.list.lock.release()
+			self.executor.submit(self.work, entries, cost)
+			
+			# write the updated maintenance list to file
+			if time.time() - self.list.last_flush >= config.max_acm_flush_interval:
+				self.list.flush()
 				
-				# write the updated maintenance list to file
-				if time.time() - self.list.last_flush >= config.max_acm_flush_interval:
-					self.list.flush()
+			if time.time() - self.list.last_refit >= config.maintenance_model['refit_interval']:
+				self.list.refit()
+			
+			if config.debug_memory:
+				with self.list.lock:
+					items = sum([x.asizeof() for x in self.list.entries.values()])
 				
-				if config.debug_memory:
-					items = sum([x.asizeof() for x in self.list.list])
-					
-					logging.debug("# of cached items: {}".format(items))
+				logging.debug("# of cached items: {}".format(items))
+			
+	# Runs on a worker thread
+	def work(self, entries, cost):
+		# Exception handler shell
+		try:
+			start = time.time()
+			
+			if self.maintain(entries, cost):
+				self.observe(time.time() - start)
+		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
+		except BaseException:
+			logging.exception("Fatal error occurred in ACM worker.")
+			_thread.interrupt_main()
+			os._exit(1)
+			raise
+		finally:
+			with self.slots:
+				self.running -= 1
+				self.slots.notify()
 				
-			self.sleep()
+	def observe(self, elapsed):
+		with self.slots:
+			if self.batch_time is None:
+				self.batch_time = elapsed
+			else:
+				self.batch_time = 0.2 * elapsed + 0.8 * self.batch_time
+				
+	# Maintains a batch of entries. Stops early once the main thread wakes
+	# up, the rest go back into the list as they were. Returns whether the
+	# whole batch was maintained.
+	def maintain(self, entries, cost):
+		if not self.bot.acm_event.is_set():
+			self.requeue(entries)
+			self.budget.refund(cost)
+			return False
+			
+		refreshed = set()
+		
+		if config.maintenance_batch_size > 1:
+			refreshed = self.list.refresh_batch(entries)
+		
+		for i, entry in enumerate(entries):
+			if not self.bot.acm_event.is_set():
+				self.requeue(entries[i:])
+				return False
+				
+			entry.maintain(refreshed=entry in refreshed)
+			
+		return True
+			
+	def requeue(self, entries):
+		logging.debug("ACM interrupted, returning {} entries to the list.".format(len(entries)))
+		
+		for entry in entries:
+			# anything fetched for it will be stale by its turn
+			entry.comment = None
+			entry.parent = None
+			self.list.push(entry)
 			
 	def run(self):
 		logging.debug("Started ACM daemon thread.")
@@ -499,31 +605,70 @@ class aggressive_maintainer_t(threading.Thread):
 			raise
 		
 class maintain_list_t:
-	def __init__(self, bot, file_path):
+	# seconds between WAL compactions by the writer
+	compact_interval = 3600
+	
+	# info is where batches of replies and parents are fetched from, reddit
+	# unless told otherwise, see info_source
+	def __init__(self, bot, file_path, info=None):
 		self.bot = bot
+		# only read once, to import a list saved by older versions
 		self.file_path = file_path
+		self.store = bot.store
 		self.reddit = bot.reddit
+		self.info = info if info is not None else reddit_info_source_t(bot.reddit)
 		self.replied_to = bot.replied_to
 		self.last_flush = 0
-		
-		self.list = []
-		self.retired_list = []
+		self.last_compact = time.time()
+		
+		# Changes are written incrementally: every entry that was added,
+		# rescheduled or removed since the last flush, comment_id -> snapshot
+		# of its row, or None if it is to be deleted. Flushes hand the
+		# changes to a single writer thread so the writes stay in order and
+		# never hold up the ACM.
+		self.dirty = {}
+		# reply bodies posted or edited since the last flush, comment_id ->
+		# (hash, compressed body), see entry_t.set_shadow()
+		self.shadows = {}
+		self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='MaintainWriter')
+		
+		# Entries are scheduled on a heap of (due time, seq, entry) ordered by
+		# entry_t.get_due(). Rescheduling or removing an entry doesn't touch
+		# the heap, the stale item is skipped once it reaches the top, see
+		# pop_next(). An item is current only if its seq matches its entry's.
+		self.entries = {}
+		self.heap = []
+		self.seq = 0
+		# comment_id -> entry for entries taken out of the list to be
+		# maintained, until they're pushed back, dropped or archived
+		self.in_flight = {}
+		# entries retired since the last flush, moved to the archive table by
+		# the writer
+		self.retired = []
+		self.archived = 0
+		
+		# what each check saw of its parent, see entry_t.record(). Recorded
+		# observations are added to the maintain_stats counters with the next
+		# flush and the interval model is refit from those every
+		# refit_interval.
+		self.model = hazard_model_t(config.maintenance_model)
+		self.events = []
+		self.last_refit = 0
 
 		# list modification lock
-		# acquire this lock when modifying self.list to prevent multithread issues
-		self.lock = threading.RLock()
+		# acquire this lock when modifying the list to prevent multithread issues
+		self.lock = util.timed_lock_t('maintain list')
+		# set whenever an entry is (re)inserted, wakes an idle ACM
+		self.pushed = threading.Event()
 		# use of a reetrant lock allows a single thread to acquire the lock multiples
 		# times without blocking, which may be necessary in case a locking method
 		# calls another locking method during its runtime
 		
-		if not os.path.isfile(file_path):
-			self.lock.acquire()
-			self.list = []
-			self.lock.release()
-		else:
-			#self.__init_from_file__()
-			self.__init_from_json__()
-			self.sort()
+		self.__import_legacy__()
+		self.__import_events__()
+		self.refit()
+		self.__init_from_store__()
+		self.sort()
 		
 		if config.aggressive_maintenance_utilization > 0:
 			self.thread = aggressive_maintainer_t(self)
@@ -532,83 +677,231 @@ class maintain_list_t:
 		else:
 			logging.debug("ACM is disabled.")
 			
-	def __init_from_json__(self):
+	def __import_legacy__(self):
+		if not os.path.isfile(self.file_path):
+			return
+			
+		with self.store.transaction() as conn:
+			if not self.store.is_empty('maintain_list'):
+				return
+				
+			with open(self.file_path, 'r') as f:
+				list = json.load(f)
+				
+			conn.executemany("INSERT OR IGNORE INTO maintain_list (comment_id, created_utc, last_time, owner) VALUES (?, ?, ?, ?)", [
+				(jdict['comment_id'], int(jdict['created_utc']), int(jdict.get('last_time', 0)), -1) for jdict in list
+			])
+			
+		logging.info("Imported {} maintenance entries from {}.".format(len(list), self.file_path))
+			
+	# Counts observations recorded before they were kept as counters
+	def __import_events__(self):
+		with self.store.transaction() as conn:
+			if not self.store.is_empty('maintain_stats') or self.store.is_empty('maintain_events'):
+				return
+				
+			rows = conn.execute("SELECT time, comment_id, subreddit, author, from_age, to_age, kind, event_age FROM maintain_events").fetchall()
+			maintain_list_t.add_counters(conn, maintain_list_t.count_events(rows))
+			
+		logging.info("Counted {} maintenance observations.".format(len(rows)))
+		
+	def __init_from_store__(self):
 		self.lock.acquire()
-
-		processed = {}
-	
-		with open(self.file_path, 'r') as f:
-			list = json.load(f)
+		
+		rows = self.store.execute("SELECT comment_id, created_utc, last_time, owner, parent_id, fingerprint, hash FROM maintain_list LEFT JOIN reply_shadow USING (comment_id)")
+		
+		for comment_id, created_utc, last_time, owner, parent_id, fingerprint, body_hash in rows:
+			# other shards maintain the rest
+			if not self.store.is_owner(comment_id, owner):
+				continue
+				
+			entry = entry_t(self, {
+				'comment_id': comment_id,
+				'created_utc': created_utc,
+				'last_time': last_time,
+				'parent_id': parent_id,
+				'fingerprint': fingerprint,
+				'body_hash': body_hash,
+			})
 			
-			for jdict in list:
-				if jdict['comment_id'] in processed:
-					continue
+			# retired while the bot was down
+			if entry.retired:
+				self.archive(entry)
+				continue
 			
-				entry = entry_t(self, jdict)
-				self.list.append( entry )
-					
-				processed[entry.comment_id] = True
+			self.entries[entry.comment_id] = entry
 			
-			logging.debug("Populated maintain_list_t with {} entries.".format(len(self)))
+		logging.debug("Populated maintain_list_t with {} entries.".format(len(self)))
+		
+		if self.archived > 0:
+			logging.info("Archiving {} retired maintenance entries.".format(self.archived))
+			self.flush()
 
 		self.lock.release()
 		
 	def __len__(self):
-		return len(self.list)
-	
-	@staticmethod
-	def sorter(a):
-		return a.time
+		return len(self.entries)
 		
+	# Rebuilds the heap from the current entries, dropping stale items
 	def sort(self):
 		self.lock.acquire()
-		self.list.sort(key=maintain_list_t.sorter)
+		
+		self.heap = []
+		
+		for entry in self.entries.values():
+			self.seq += 1
+			entry.seq = self.seq
+			self.heap.append( (entry.get_due(), entry.seq, entry) )
+			
+		heapq.heapify(self.heap)
+		
 		self.lock.release()
 		
-	def binary_insert(self, entry):
+	def push(self, entry):
 		self.lock.acquire()
-
-		# binary search for the index to insert at
 		
-		# define search boundaries
-		lower = -1
-		upper = len(self)
+		# an entry that's being maintained comes back in when its worker is
+		# done with it, never alongside another entry for the same comment
+		current = self.in_flight.get(entry.comment_id)
 		
-		# while our boundaries have not crossed
-		while abs( lower - upper ) > 1:
-			# take the average
-			middle = int( math.floor( ( lower + upper ) / 2  ) )
+		if current is not None and current is not entry:
+			logging.warning("{:s} is being maintained, not inserting another entry for it.".format(entry.comment_id))
+			self.lock.release()
+			return
 			
-			# move the upper or lower boundary to halve the search space
-			if self.list[middle].time > entry.time:
-				upper = middle
-			else:
-				lower = middle
+		self.in_flight.pop(entry.comment_id, None)
+		
+		self.seq += 1
+		entry.seq = self.seq
+		self.entries[entry.comment_id] = entry
+		heapq.heappush(self.heap, (entry.get_due(), entry.seq, entry))
+		self.dirty[entry.comment_id] = entry.to_dict()
+		self.pushed.set()
+		
+		logging.debug("Inserting {:s} into maintain list to be refreshed at [{}].".format(entry.comment_id, datetime.datetime.fromtimestamp(entry.time)))
+		
+		# stale items pile up if entries keep being rescheduled before they
+		# come due
+		if len(self.heap) > 2 * len(self.entries) + 64:
+			self.sort()
+			
+		self.lock.release()
+		
+	def is_current(self, item):
+		due, seq, entry = item
+		return self.entries.get(entry.comment_id) is entry and entry.seq == seq
+		
+	def peek(self):
+		while len(self.heap) > 0 and not self.is_current(self.heap[0]):
+			heapq.heappop(self.heap)
+			
+		if len(self.heap) == 0:
+			return None
+			
+		return self.heap[0][2]
+		
+	# Earliest time the next entry can be maintained, ahead of schedule or
+	# not, see pop_next(). None if there are no entries.
+	def get_next_time(self):
+		with self.lock:
+			entry = self.peek()
+			
+			return entry.last_time + 35 if entry is not None else None
+			
+	# Removes and returns the entry that is due soonest, if it can be
+	# maintained at time now
+	def pop_next(self, now):
+		self.lock.acquire()
+		
+		entry = self.peek()
+		
+		if entry is not None and entry.last_time + 35 <= now:
+			heapq.heappop(self.heap)
+			del self.entries[entry.comment_id]
+			self.in_flight[entry.comment_id] = entry
+		else:
+			entry = None
+			
+		self.lock.release()
+		
+		return entry
+		
+	def pop_batch(self, now, n):
+		entries = []
+		
+		while len(entries) < n:
+			entry = self.pop_next(now)
+			
+			if entry is None:
+				break
 				
-		logging.debug("Inserting {:s} into maintain list at idx={:.0f} to be refreshed at [{}].".format(entry.comment_id, upper, datetime.datetime.fromtimestamp(entry.time)))
+			entries.append(entry)
+			
+		return entries
+		
+	@retry(retry_on_exception=util.is_praw_error,
+		   wait_exponential_multiplier=config.praw_error_wait_time,
+		   wait_func=util.praw_error_retry)
+	def refresh_batch(self, entries):
 		'''
-		if lower >= 0:
-			logging.info(float(deletion_check_list[lower]['time']))
-		if upper < len(deletion_check_list):
-			logging.info(float(deletion_check_list[upper]['time']))
+		Fetches the replies and parents of several entries together through
+		/api/info, instead of two or more requests per entry. Returns the
+		entries that were refreshed, the rest refresh themselves in maintain().
 		'''
+		objects = self.info.fetch(
+			['t1_' + e.comment_id for e in entries] +
+			[e.parent_id for e in entries if e.parent_id is not None]
+		)
+		
+		# parents of replies that were added before parent IDs were recorded
+		# take a second round
+		missing = [objects['t1_' + e.comment_id].parent_id for e in entries if e.parent_id is None and 't1_' + e.comment_id in objects]
+		
+		if len(missing) > 0:
+			objects.update(self.info.fetch(missing))
 			
-		self.list.insert(upper, entry)
-
-		self.lock.release()
-			
-	def add(self, comment):
-		entry = entry_t(self, {
-			"comment_id": comment.id,
-			"created_utc": comment.created_utc,
-		})
+		refreshed = set()
 		
-		self.add_entry( entry )
+		for e in entries:
+			comment = objects.get('t1_' + e.comment_id)
+			
+			if comment is None:
+				continue
+				
+			e.parent_id = comment.parent_id
+			parent = objects.get(e.parent_id)
+			
+			if parent is None:
+				continue
+				
+			e.comment = praw_object_wrapper_t(self.bot, comment)
+			e.parent = praw_object_wrapper_t(self.bot, parent)
+			refreshed.add(e)
+			
+		return refreshed
+		
+	def add(self, comment, fingerprint=None):
+		self.add_many([(comment, fingerprint)])
+		
+	# Adds several (comment, fingerprint) pairs with a single flush. The
+	# fingerprint is of the parent the reply was rendered from, see
+	# entry_t.get_fingerprint().
+	def add_many(self, comments):
+		for comment, fingerprint in comments:
+			entry = entry_t(self, {
+				"comment_id": comment.id,
+				"created_utc": comment.created_utc,
+				"parent_id": comment.parent_id,
+				"fingerprint": fingerprint,
+			})
+			entry.set_shadow(comment.body)
+			
+			self.add_entry( entry )
 
 		self.flush()
 			
 	def add_entry(self, entry):
-		self.binary_insert( entry )
+		self.push( entry )
 
 	def flag_for_edits(self, args):
 		if not ( '-force' in args and args.index('-force') < len(args) ):
@@ -617,7 +910,9 @@ class maintain_list_t:
 		time_str = args[ args.index('-force') + 1 ]
 		cutoff = time.time() - util.parse_time_str(time_str)
 		
-		filtered = [x for x in self.list if x.created_utc >= cutoff]
+		self.revive(cutoff)
+		
+		filtered = [x for x in self.entries.values() if x.created_utc >= cutoff]
 		
 		for e in filtered:
 			e.flag()
@@ -630,8 +925,11 @@ class maintain_list_t:
 		self.flush()
 		
 	def next_time(self):
-		if len(self) > 0:
-			return self.list[0].time
+		with self.lock:
+			entry = self.peek()
+			
+		if entry is not None:
+			return entry.get_due()
 		else:
 			return None
 			
@@ -643,32 +941,170 @@ class maintain_list_t:
 		if not self.is_active():
 			return
 		
-		self.lock.acquire()
-
-		# pop the first entry
-		entry = self.list.pop(0)
+		entry = self.pop_next(time.time())
 		
-		entry.maintain()
-
-		self.lock.release()
+		if entry is not None:
+			entry.maintain()
 		
 		# write the updated maintenance list to file
 		self.flush()
 		
+	# Marks an entry that left the list for deletion from the store
+	def drop(self, entry):
+		with self.lock:
+			self.in_flight.pop(entry.comment_id, None)
+			self.dirty[entry.comment_id] = None
+			
+	# Moves an entry that no longer needs maintaining to the archive. It's
+	# out of memory from here on, see revive().
+	def archive(self, entry):
+		with self.lock:
+			self.in_flight.pop(entry.comment_id, None)
+			self.dirty[entry.comment_id] = None
+			self.retired.append( {
+				'comment_id': entry.comment_id,
+				'created_utc': int(entry.created_utc),
+				'parent_id': entry.parent_id,
+				'owner': self.store.shard,
+			} )
+			self.archived += 1
+			
+	# Brings archived entries created since the given time back into the
+	# list, e.g. to update them with -force. They retire again after their
+	# next maintenance.
+	def revive(self, since):
+		# pending archive writes have to land first
+		self.flush()
+		self.writer.submit(lambda: None).result()
+		
+		with self.store.transaction() as conn:
+			rows = conn.execute("SELECT comment_id, created_utc, parent_id, owner FROM maintain_archive WHERE created_utc >= ?", (since,)).fetchall()
+			rows = [row for row in rows if self.store.is_owner(row[0], row[3])]
+			
+			conn.executemany("DELETE FROM maintain_archive WHERE comment_id = ?", [(row[0],) for row in rows])
+			conn.executemany("INSERT OR REPLACE INTO maintain_list (comment_id, created_utc, last_time, owner, parent_id) VALUES (?, ?, 0, ?, ?)", [
+				(comment_id, created_utc, self.store.shard, parent_id) for comment_id, created_utc, parent_id, owner in rows
+			])
+			
+		for comment_id, created_utc, parent_id, owner in rows:
+			self.push( entry_t(self, {
+				'comment_id': comment_id,
+				'created_utc': created_utc,
+				'parent_id': parent_id,
+				'retired': False,
+			}) )
+			
+		if len(rows) > 0:
+			logging.info("Revived {} archived maintenance entries.".format(len(rows)))
+			
+		return len(rows)
+			
+	def shadow(self, comment_id, hash, body):
+		with self.lock:
+			self.shadows[comment_id] = (hash, zlib.compress(body.encode('utf-8')))
+			
+	# The reply's body as last posted or edited, None if no copy was kept
+	def get_shadow(self, comment_id):
+		with self.lock:
+			if comment_id in self.shadows:
+				return zlib.decompress(self.shadows[comment_id][1]).decode('utf-8')
+				
+		row = self.store.execute("SELECT body FROM reply_shadow WHERE comment_id = ?", (comment_id,)).fetchone()
+		
+		return zlib.decompress(row[0]).decode('utf-8') if row is not None else None
+		
+	def record(self, event):
+		with self.lock:
+			self.events.append(event)
+			
+	# Fits the interval model to the counters for the recent history of
+	# observations, added up over the days. Entries pick the new intervals up
+	# as they're rescheduled.
+	def refit(self):
+		settings = config.maintenance_model
+		self.last_refit = time.time()
+		
+		counters = self.store.execute("SELECT bin, NULLIF(subreddit, ''), NULLIF(author, ''), SUM(exposure), SUM(events) FROM maintain_stats WHERE day >= ? GROUP BY bin, subreddit, author", (
+			int((self.last_refit - settings['history']) // 86400),
+		))
+		
+		model = hazard_model_t(settings)
+		model.fit(counters)
+		self.model = model
+		
+	# Rows for the maintain_stats table from recorded observations, counted
+	# by the day they were made on. Missing subreddits and authors are stored
+	# as empty strings so they're part of the key.
+	@staticmethod
+	def count_events(events):
+		days = {}
+		
+		for event in events:
+			days.setdefault(int(event[0] // 86400), []).append(event[2:])
+			
+		return [
+			(day, bin, subreddit or '', author or '', exposure, count)
+			for day, rows in days.items()
+			for (bin, subreddit, author), (exposure, count) in maintenance_model.count(rows).items()
+		]
+		
+	@staticmethod
+	def add_counters(conn, counters):
+		conn.executemany("INSERT OR IGNORE INTO maintain_stats (day, bin, subreddit, author, exposure, events) VALUES (?, ?, ?, ?, 0, 0)", [c[:4] for c in counters])
+		conn.executemany("UPDATE maintain_stats SET exposure = exposure + ?, events = events + ? WHERE day = ? AND bin = ? AND subreddit = ? AND author = ?", [c[4:] + c[:4] for c in counters])
+		
 	def flush(self):
-		#start = time.time()
-
-		with atomic_write(self.file_path, overwrite=True) as f:
-			json.dump(self.list, f, cls=entry_encoder_t, sort_keys=True, indent=4)
-
-		#json.dumps(self.list + self.retired_list, f, cls=entry_encoder_t, sort_keys=True, indent=4)
+		with self.lock:
+			dirty = self.dirty
+			self.dirty = {}
+			retired = self.retired
+			self.retired = []
+			events = self.events
+			self.events = []
+			shadows = self.shadows
+			self.shadows = {}
 			
-		#logging.debug("Saved maintenance list to file. ({:.3f}s elapsed)".format(time.time()-start)
-		logging.debug("Saved maintenance list to file.")
-
 		self.last_flush = time.time()
+		
+		if len(dirty) > 0 or len(retired) > 0 or len(events) > 0 or len(shadows) > 0:
+			self.writer.submit(self.write, dirty, retired, events, shadows)
 			
+	# Runs on the writer thread
+	def write(self, dirty, retired, events=(), shadows={}):
+		try:
+			rows = [dict(row, owner=self.store.shard) for row in dirty.values() if row is not None]
+			removed = [(id,) for id, row in dirty.items() if row is None]
 			
+			with self.store.transaction() as conn:
+				conn.executemany("INSERT OR REPLACE INTO maintain_list (comment_id, created_utc, last_time, owner, parent_id, fingerprint) VALUES (:comment_id, :created_utc, :last_time, :owner, :parent_id, :fingerprint)", rows)
+				conn.executemany("DELETE FROM maintain_list WHERE comment_id = ?", removed)
+				conn.executemany("INSERT OR REPLACE INTO reply_shadow (comment_id, hash, body) VALUES (?, ?, ?)", [
+					(comment_id, hash, body) for comment_id, (hash, body) in shadows.items()
+				])
+				# nothing is edited once it's out of the list
+				conn.executemany("DELETE FROM reply_shadow WHERE comment_id = ?", removed)
+				conn.executemany("INSERT OR REPLACE INTO maintain_archive (comment_id, created_utc, parent_id, owner) VALUES (:comment_id, :created_utc, :parent_id, :owner)", retired)
+				maintain_list_t.add_counters(conn, maintain_list_t.count_events(events))
+				
+				# the observations themselves are only kept for a sample of
+				# replies, for benchmark.py to replay
+				sample = config.maintenance_model['evaluation_sample']
+				conn.executemany("INSERT INTO maintain_events (time, comment_id, subreddit, author, from_age, to_age, kind, event_age) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+					event for event in events if sample > 0 and zlib.crc32(event[1].encode('utf-8')) % sample == 0
+				])
+				
+			logging.debug("Saved {} changed, {} removed and {} archived maintenance entries to store.".format(len(rows), len(removed), len(retired)))
 			
-			
-			
\ No newline at end of file
+			# fold the WAL back into the database now and then, after dropping
+			# observations too old to be fit to
+			if time.time() - self.last_compact >= maintain_list_t.compact_interval:
+				cutoff = time.time() - config.maintenance_model['history']
+				self.store.execute("DELETE FROM maintain_events WHERE time < ?", (cutoff,))
+				self.store.execute("DELETE FROM maintain_stats WHERE day < ?", (int(cutoff // 86400),))
+				self.store.compact()
+				self.last_compact = time.time()
+		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
+		except BaseException:
+			logging.exception("Fatal error occurred in maintenance writer.")
+			os._exit(1)
+			raise
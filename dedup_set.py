@@ -0,0 +1,199 @@
+# Python
+import time
+import math
+import bisect
+from array import array
+from collections import deque
+
+# 3rd Party
+# Self
+
+# =============================================================================
+
+'''
+Bounded set of reddit IDs that forgets anything older than a fixed window.
+
+IDs are base36 strings, so they are packed into integers before being stored.
+The window is split into buckets: the bucket currently being filled is a
+regular set, and once its time slot has passed it is sealed into a sorted
+array of 8 byte integers and searched with bisect. Reddit hands out IDs in
+ascending order, so each sealed bucket covers a narrow ID range and a lookup
+only has to bisect the bucket(s) whose range contains it. Sealed buckets that have
+fallen out of the window are dropped wholesale, which keeps memory flat
+no matter how long the process runs.
+
+An optional Bloom filter sits in front of all buckets so that the common
+case (an ID we have never seen) is answered without touching them.
+'''
+
+def pack_id(id):
+	return int(id, 36)
+
+class bloom_filter_t:
+	def __init__(self, capacity, error_rate=0.01):
+		capacity = max(int(capacity), 1)
+
+		# optimal number of bits and hash functions for the given capacity
+		self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+		self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+		self.capacity = capacity
+		self.count = 0
+		self.bits = bytearray((self.size + 7) // 8)
+
+	@staticmethod
+	def mix(n):
+		# splitmix64 finalizer, spreads sequential IDs across the bit array
+		n = (n + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+		n = ((n ^ (n >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+		n = ((n ^ (n >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+		return n ^ (n >> 31)
+
+	def positions(self, n):
+		# double hashing, derive k positions from the two halves of one hash
+		h = bloom_filter_t.mix(n)
+		h1 = h & 0xFFFFFFFF
+		h2 = (h >> 32) | 1
+		size = self.size
+
+		return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+	def add(self, n):
+		bits = self.bits
+
+		for p in self.positions(n):
+			bits[p >> 3] |= 1 << (p & 7)
+
+		self.count += 1
+
+	def __contains__(self, n):
+		bits = self.bits
+
+		for p in self.positions(n):
+			if not bits[p >> 3] & (1 << (p & 7)):
+				return False
+
+		return True
+
+	def nbytes(self):
+		return len(self.bits)
+
+class dedup_set_t:
+	def __init__(self, window, buckets=24, bloom=False, bloom_capacity=100000):
+		self.window = window
+		self.buckets = buckets
+		self.width = window / buckets
+		self.use_bloom = bloom
+		self.bloom_capacity = bloom_capacity
+		self.bloom = bloom_filter_t(bloom_capacity) if bloom else None
+
+		self.live = set()
+		self.live_bucket = None
+		# highest ID in any sealed bucket
+		self.high = 0
+		# (bucket index, lowest ID, highest ID, sorted array of packed IDs),
+		# oldest first
+		self.sealed = deque()
+
+	def __len__(self):
+		return len(self.live) + sum(len(a) for b, lo, hi, a in self.sealed)
+
+	def get_bucket(self, now):
+		return int(now // self.width)
+
+	def rotate(self, now):
+		bucket = self.get_bucket(now)
+
+		if self.live_bucket is None:
+			self.live_bucket = bucket
+
+		# clock went backwards or we're still in the same slot
+		if bucket <= self.live_bucket:
+			return
+
+		if len(self.live) > 0:
+			a = array('Q', sorted(self.live))
+			self.sealed.append((self.live_bucket, a[0], a[-1], a))
+			self.high = max(self.high, a[-1])
+			self.live = set()
+
+		self.live_bucket = bucket
+
+		expired = False
+
+		while len(self.sealed) > 0 and self.sealed[0][0] <= bucket - self.buckets:
+			self.sealed.popleft()
+			expired = True
+
+		if expired and self.use_bloom:
+			self.rebuild_bloom()
+
+	def rebuild_bloom(self):
+		# bloom filters can't forget, so rebuild from whatever is left
+		self.bloom = bloom_filter_t(max(self.bloom_capacity, 2 * len(self)))
+
+		for b, lo, hi, a in self.sealed:
+			for n in a:
+				self.bloom.add(n)
+
+		for n in self.live:
+			self.bloom.add(n)
+
+	def add(self, id, now=None):
+		if now is None:
+			now = time.time()
+
+		self.rotate(now)
+
+		n = pack_id(id)
+		self.live.add(n)
+
+		if self.bloom is not None:
+			self.bloom.add(n)
+
+			if self.bloom.count > self.bloom.capacity:
+				self.rebuild_bloom()
+
+	def contains(self, id, now=None):
+		if now is None:
+			now = time.time()
+
+		self.rotate(now)
+
+		n = pack_id(id)
+
+		if self.bloom is not None and n not in self.bloom:
+			return False
+
+		if n in self.live:
+			return True
+
+		# brand new IDs are above every sealed bucket, which is by far the
+		# most common lookup the stream does
+		if len(self.sealed) == 0 or n > self.high:
+			return False
+
+		# newest buckets first, recent IDs are the likeliest repeats
+		for b, lo, hi, a in reversed(self.sealed):
+			if n < lo or n > hi:
+				continue
+
+			i = bisect.bisect_left(a, n)
+
+			if i < len(a) and a[i] == n:
+				return True
+
+		return False
+
+	def __contains__(self, id):
+		return self.contains(id)
+
+	def nbytes(self):
+		# approximate footprint: 8 bytes per sealed ID plus the live set's
+		# hash table and int objects
+		b = sum(a.itemsize * len(a) for b, lo, hi, a in self.sealed)
+		b += len(self.live) * (28 + 16)
+
+		if self.bloom is not None:
+			b += self.bloom.nbytes()
+
+		return b
@@ -0,0 +1,77 @@
+# Python
+import json
+import time
+import logging
+
+# 3rd Party
+# Self
+from config import config_helper as config
+
+# =============================================================================
+
+'''
+Durable work queue kept in the state store, used to connect the processes of
+the pipeline mode.
+
+Consumers lease an item rather than removing it. The item is only deleted once
+the consumer acks it, so if the consumer dies first the lease runs out and the
+item is handed to the next consumer. Items that keep getting leased without
+being acked are dropped after a few attempts so one bad item can't wedge the
+queue.
+'''
+
+class durable_queue_t:
+	max_attempts = 5
+
+	def __init__(self, store, name):
+		self.store = store
+		self.name = name
+
+	def __len__(self):
+		return self.store.execute("SELECT COUNT(*) FROM queue WHERE name = ?", (self.name,)).fetchone()[0]
+
+	def put(self, payload, priority=None, key=None):
+		if priority is None:
+			priority = time.time()
+
+		self.store.execute("INSERT INTO queue (name, key, payload, priority) VALUES (?, ?, ?, ?)", (
+			self.name,
+			key,
+			json.dumps(payload),
+			priority,
+		))
+
+	# Leases the most urgent item. Returns (id, payload), or None if there is
+	# nothing available.
+	def get(self):
+		now = time.time()
+
+		with self.store.transaction() as conn:
+			while True:
+				row = conn.execute("SELECT id, payload, attempts FROM queue WHERE name = ? AND lease_until < ? ORDER BY priority, id LIMIT 1", (self.name, now)).fetchone()
+
+				if row is None:
+					return None
+
+				id, payload, attempts = row
+
+				if attempts >= durable_queue_t.max_attempts:
+					logging.error("Dropping {} queue item {} after {} attempts: {}".format(self.name, id, attempts, payload))
+					conn.execute("DELETE FROM queue WHERE id = ?", (id,))
+					continue
+
+				conn.execute("UPDATE queue SET lease_until = ?, attempts = attempts + 1 WHERE id = ?", (now + config.pipeline_lease, id))
+
+				return id, json.loads(payload)
+
+	# Extends the lease on items that are still being worked on
+	def touch(self, ids):
+		until = time.time() + config.pipeline_lease
+
+		self.store.conn.executemany("UPDATE queue SET lease_until = ? WHERE id = ?", [(until, id) for id in ids])
+
+	def ack(self, id):
+		self.store.execute("DELETE FROM queue WHERE id = ?", (id,))
+
+	def contains_key(self, key):
+		return self.store.execute("SELECT 1 FROM queue WHERE name = ? AND key = ? LIMIT 1", (self.name, key)).fetchone() is not None
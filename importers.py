@@ -6,18 +6,34 @@ import os
 import logging
 import json
 import zlib
+import threading
 import urllib.request, urllib.error, urllib.parse
 from xml import etree
 from functools import cached_property
 
 # 3rd Party
 import defusedxml.ElementTree as ET
-from atomicwrites import atomic_write
 
 # Self
 import util
 import pob_party
 
+# state_store_t the blacklists are kept in, set by the bot at startup
+store = None
+
+# Optional concurrent.futures.Executor that XML decoding is offloaded to, set
+# by the stream manager when decode processes are configured.
+decode_pool = None
+
+def decode_xml(enc):
+	bytelike = enc.decode()
+	replaced = bytelike.replace('-', '+').replace('_', '/')
+	decoded = base64.b64decode( replaced )
+	
+	xml_str = zlib.decompress( decoded )
+	
+	return ET.fromstring(xml_str)
+
 class ImporterEncoder(json.JSONEncoder):
 	def default(self, obj):
 		if isinstance(obj, ImporterBase):
@@ -28,24 +44,31 @@ class ImporterEncoder(json.JSONEncoder):
 		return json.JSONEncoder.default(self, obj)
 
 class ImporterBase(object):
-	def is_blacklisted(self):
-		if not self.initialized:
-			self.init_blacklist()
+	# guards the blacklists, importers are resolved on several threads at once
+	lock = threading.RLock()
 	
-		return self.key in self.blacklist_contents
-		
-	def blacklist(self):
+	def is_blacklisted(self):
 		if not self.initialized:
 			self.init_blacklist()
 			
 		if self.key in self.blacklist_contents:
-			return
+			return True
+	
+		# may have been blacklisted by another shard
+		return store.execute("SELECT 1 FROM blacklist WHERE kind = ? AND key = ?", (type(self).__name__, self.key)).fetchone() is not None
 		
-		self.blacklist_contents[self.key] = True
-			
-		logging.info("Blacklisted {}.".format(self))
+	def blacklist(self):
+		with self.lock:
+			if not self.initialized:
+				self.init_blacklist()
+				
+			if self.key in self.blacklist_contents:
+				return
 			
-		self.flush()
+			self.blacklist_contents[self.key] = True
+			store.execute("INSERT OR IGNORE INTO blacklist (kind, key) VALUES (?, ?)", (type(self).__name__, self.key))
+				
+			logging.info("Blacklisted {}.".format(self))
 	
 	# returns text contents of importer
 	@cached_property
@@ -71,13 +94,10 @@ class ImporterBase(object):
 			return None
 		
 	def decode(self, enc):
-		bytelike = enc.decode()
-		replaced = bytelike.replace('-', '+').replace('_', '/')
-		decoded = base64.b64decode( replaced )
-		
-		xml_str = zlib.decompress( decoded )
-		
-		return ET.fromstring(xml_str)
+		if decode_pool is not None:
+			return decode_pool.submit(decode_xml, enc).result()
+			
+		return decode_xml(enc)
 		
 	def is_pob_xml(self):
 		if self.xml is not None:
@@ -98,45 +118,53 @@ class ImporterBase(object):
 		match = re.search('\w+$', url) 
 		return match.group(0)
 		
+	# One time import of the files the blacklists used to be kept in
 	@classmethod
-	def init_blacklist(cls):
+	def import_legacy_blacklist(cls):
+		keys = None
+		src = None
+		
 		if os.path.isfile(cls.path):
 			with open(cls.path, 'r') as f:
-				cls.blacklist_contents = json.load(f)
+				keys = list(json.load(f).keys())
 				
-			logging.debug("Loaded {} blacklist from {} with {} entries.".format(
-				cls.__name__,
-				cls.path,
-				len(cls.blacklist_contents)
-			))
+			src = cls.path
 		elif os.path.isfile("{}_blacklist.txt".format(cls.__name__.lower())):
-			with open("{}_blacklist.txt".format(cls.__name__.lower())) as f:
-				list = f.read()
-				list = list.split("\n")
-				list = [_f for _f in list if _f]
+			src = "{}_blacklist.txt".format(cls.__name__.lower())
+			
+			with open(src) as f:
+				keys = [_f for _f in f.read().split("\n") if _f]
 				
-				for entry in list:
-					cls.blacklist_contents[entry] = True
-					
-			logging.debug("Loaded {} blacklist from {} with {} entries.".format(
-				cls.__name__,
-				"{}_blacklist.txt".format(cls.__name__.lower()),
-				len(cls.blacklist_contents)
-			))
+		if keys is None:
+			return
 			
-			cls.flush()
-		else:
-			cls.blacklist_contents = {}
-			logging.debug("Defaulted {} blacklist.".format(cls.__name__))
+		with store.transaction() as conn:
+			if conn.execute("SELECT 1 FROM blacklist WHERE kind = ? LIMIT 1", (cls.__name__,)).fetchone() is not None:
+				return
+				
+			conn.executemany("INSERT OR IGNORE INTO blacklist (kind, key) VALUES (?, ?)", [(cls.__name__, key) for key in keys])
 			
-		cls.initialized = True
-	
+		logging.info("Imported {} {} blacklist entries from {}.".format(len(keys), cls.__name__, src))
+		
 	@classmethod
-	def flush(cls):
-		with atomic_write(cls.path, overwrite=True) as f:
-			json.dump(cls.blacklist_contents, f, sort_keys=True, indent=4)
+	def init_blacklist(cls):
+		with cls.lock:
+			if cls.initialized:
+				return
+				
+			cls.import_legacy_blacklist()
+			
+			cls.blacklist_contents = {}
 			
-		logging.debug("{} blacklist saved to {}".format(cls.__name__, cls.path))
+			for (key,) in store.execute("SELECT key FROM blacklist WHERE kind = ?", (cls.__name__,)):
+				cls.blacklist_contents[key] = True
+				
+			logging.debug("Loaded {} blacklist with {} entries.".format(
+				cls.__name__,
+				len(cls.blacklist_contents)
+			))
+				
+			cls.initialized = True
 
 class Pastebin(ImporterBase):
 	blacklist_contents = {}
@@ -239,4 +267,13 @@ class PoBParty(ImporterBase):
 			pob_party.set_key(self)
 
 		return super(PoBParty, self).xml
-	
+
+# Importers for every supported link in body, in order of appearance
+def find_importers(body):
+	for match in re.finditer('pastebin\.com/\w+', body):
+		bin = "https://" + match.group(0)
+		yield Pastebin(url=bin)
+
+	for match in re.finditer('pob\.party/share/\w+', body):
+		url = "https://" + match.group(0)
+		yield PoBParty(url=url)
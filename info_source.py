@@ -0,0 +1,63 @@
+# Python
+import math
+import logging
+
+# 3rd Party
+# Self
+
+# =============================================================================
+
+'''
+Where comment maintenance gets its batches of comments and submissions from.
+
+reddit_info_source_t looks fullnames up through /api/info, which takes up to
+100 of them per request. local_info_source_t serves objects from memory so
+the maintenance code can be exercised offline.
+'''
+
+# fullnames per /api/info request, reddit's maximum
+BATCH_SIZE = 100
+
+class reddit_info_source_t:
+	def __init__(self, reddit):
+		self.reddit = reddit
+		self.requests = 0
+
+	# Returns {fullname: object} for every fullname reddit knows about
+	def fetch(self, fullnames):
+		fullnames = list(dict.fromkeys(fullnames))
+		objects = {}
+
+		for i in range(0, len(fullnames), BATCH_SIZE):
+			chunk = fullnames[i:i + BATCH_SIZE]
+
+			for object in self.reddit.info(fullnames=chunk):
+				objects[object.fullname] = object
+
+			self.requests += 1
+
+		logging.debug("Fetched {} of {} fullnames in {} requests.".format(len(objects), len(fullnames), math.ceil(len(fullnames) / BATCH_SIZE)))
+
+		return objects
+
+class local_info_source_t:
+	'''
+	Stand-in for reddit_info_source_t. Counts requests the same way, so the
+	effect of batching can be measured without touching the API.
+	'''
+
+	def __init__(self, objects=()):
+		self.objects = {}
+		self.requests = 0
+
+		for object in objects:
+			self.add(object)
+
+	def add(self, object):
+		self.objects[object.fullname] = object
+
+	def fetch(self, fullnames):
+		fullnames = list(dict.fromkeys(fullnames))
+		self.requests += math.ceil(len(fullnames) / BATCH_SIZE)
+
+		return {fullname: self.objects[fullname] for fullname in fullnames if fullname in self.objects}
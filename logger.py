@@ -35,15 +35,15 @@ def create_console_handler():
 	'''
 	logging.getLogger().addHandler(h)
 
-def create_log_handler():
-	h = logging.handlers.TimedRotatingFileHandler('logs/log', when='midnight', backupCount=30)
+def create_log_handler(suffix):
+	h = logging.handlers.TimedRotatingFileHandler('logs/log{}'.format(suffix), when='midnight', backupCount=30)
 	h.setFormatter(format)
 	h.setLevel(logging.INFO)
 	
 	logging.getLogger().addHandler(h)
 
-def create_debug_handler():
-	h = logging.handlers.TimedRotatingFileHandler('logs/debug', when='h', backupCount=48)
+def create_debug_handler(suffix):
+	h = logging.handlers.TimedRotatingFileHandler('logs/debug{}'.format(suffix), when='h', backupCount=48)
 	h.setFormatter(format)
 	h.setLevel(logging.DEBUG)
 	
@@ -54,7 +54,9 @@ def create_debug_handler():
 	
 	logging.getLogger().addHandler(h)
 
-def init_logging():
+# suffix is appended to the log file names, so several processes can share
+# the logs directory
+def init_logging(suffix=''):
 	log = logging.getLogger()
 	log.setLevel(logging.DEBUG)
 	# Remove the default handler
@@ -69,5 +71,5 @@ def init_logging():
 	)
 	
 	create_console_handler()
-	create_log_handler()
-	create_debug_handler()
\ No newline at end of file
+	create_log_handler(suffix)
+	create_debug_handler(suffix)
\ No newline at end of file
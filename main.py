@@ -1,4 +1,5 @@
 # Python
+import asyncio
 import time
 import os
 import re
@@ -14,6 +15,7 @@ import threading
 
 # 3rd Party
 import praw
+import requests
 import defusedxml.ElementTree as ET
 from retrying import retry
 
@@ -22,12 +24,15 @@ from config import config_helper as config
 config.set_mode('debug') # must set before importing other modules
 import util
 import status
-import logger
 import response
 import replied_to
+import importers
+from state_store import state_store_t
+from rate_budget import rate_budget_t
 from comment_maintenance import maintain_list_t
 from reply_buffer import reply_handler_t
 from reddit_stream import stream_manager_t
+import pipeline
 from logger import init_logging
 import stat_parsing
 import item
@@ -57,51 +62,90 @@ for sig in ('SIGTERM', 'SIGHUP', 'SIGINT'):
 	
 class bot_t:
 	def __init__(self):
+		self.start_time = time.time()
+		self.steady = False
+		
 		locale.setlocale(locale.LC_ALL, '')
+		
+		self.shard, self.shards = util.parse_shard(sys.argv)
+		self.stage = util.parse_pipeline(sys.argv, pipeline.STAGES)
+		# per process files get a stage and shard suffix when running more
+		# than one process
+		suffix = ".{}".format(self.stage) if self.stage != 'all' else ""
+		suffix += ".{}".format(self.shard) if self.shards > 1 else ""
 
-		with open("bot.pid", 'w') as f:
+		with open("bot{}.pid".format(suffix), 'w') as f:
 			f.write(str(os.getpid()))
 
-		init_logging()
-		status.init()
+		init_logging(suffix)
+		status.init("status{}.json".format(suffix))
+		
+		self.subreddits = self.get_shard_subreddits()
 			
 		self.login()
 		
-		self.replied_to = replied_to.replied_t("save/replied_to.json")
+		# replied to list, maintenance list and importer blacklists are shared
+		# by every shard
+		self.store = state_store_t("save/state.db", self.shard, self.shards)
+		importers.store = self.store
 		
-		logging.log(logger.DEBUG_ALL, self.replied_to.dict)
+		self.replied_to = replied_to.replied_t(self.store, "save/replied_to.json")
 		
-		self.maintain_list = maintain_list_t( self, "save/active_comments.json" )
+		# rendering needs these, and so does maintenance when it re-renders
+		# edited parents
+		if self.stage in ('all', 'render', 'post'):
+			stat_parsing.init()
+			item.init()
 
-		stat_parsing.init()
-		item.init()
+		# only the process that posts replies maintains them
+		if self.stage in ('all', 'post'):
+			self.maintain_list = maintain_list_t( self, "save/active_comments.json" )
 			
-		if '-force' in sys.argv:
-			self.maintain_list.flag_for_edits(sys.argv)
+			if '-force' in sys.argv:
+				self.maintain_list.flag_for_edits(sys.argv)
 		
-		# Init backlog state. Stream threads will toggle these bools when they
+		# Init backlog state. Ingest coroutines will toggle these bools when they
 		# have finished resolving their backlogging, allowing this main thread
 		# to know when its ok to status update.
+		ingest = self.stage in ('all', 'ingest')
 		self.backlog = {
-			'comments': True,
-			'submissions': True,
+			'comments': ingest,
+			'submissions': ingest,
 		}
 
-		self.reply_queue = reply_handler_t( self )
-		self.stream_manager = stream_manager_t( self )
+		if self.stage in ('all', 'post'):
+			self.reply_queue = reply_handler_t( self )
+		else:
+			self.reply_queue = pipeline.durable_reply_sink_t( self )
 		
-		# initialize threading event, which will let us pause execution in this
-		# thread whenever we want, and allow a stream subthread to signal to
-		# resume execution
-		self.stream_event = threading.Event()
+		if self.stage == 'all':
+			self.stream_manager = stream_manager_t( self )
+		elif self.stage == 'ingest':
+			self.stream_manager = pipeline.ingest_manager_t( self )
+		elif self.stage == 'render':
+			self.stream_manager = pipeline.render_manager_t( self )
+		else:
+			self.stream_manager = pipeline.post_feeder_t( self )
 		
-		# similarly, make an acm event that main thread can use to signal the
-		# ACM thread to go
+		# make an acm event that main thread can use to signal the ACM thread
+		# to go
 		self.acm_event = threading.Event()
 		
 		if config.debug_memory:
 			self.mem_track = tracker.SummaryTracker()
 		
+	# Subreddits this process streams. An explicit 'shards' list of subreddit
+	# lists in the settings takes precedence, so big subreddits can be kept
+	# apart from small ones, otherwise they're dealt out round robin.
+	def get_shard_subreddits(self):
+		if 'shards' in config.settings:
+			if len(config.shards) != self.shards:
+				raise ValueError("settings list {} shards but {} were requested".format(len(config.shards), self.shards))
+				
+			return config.shards[self.shard]
+			
+		return [s for i, s in enumerate(config.subreddits) if i % self.shards == self.shard]
+		
 	def is_backlogged(self):
 		return self.backlog['comments'] or self.backlog['submissions']
 
@@ -129,11 +173,24 @@ class bot_t:
 		if config.username == '[redacted]':
 			raise ValueError("settings_secret.json is not valid.")
 		
+		# every response reports the rate limit to the budget
+		self.budget = rate_budget_t()
+		self.budget.start()
+		
+		session = requests.Session()
+		session.hooks['response'].append(self.budget)
+		
 		r = praw.Reddit(username = config.username,
 			password = config.password,
 			client_id = config.client_id,
 			client_secret = config.client_secret,
-			user_agent = "linux:PoBPreviewBot:{} (by /u/aggixx)".format(self.get_git_sha()))
+			user_agent = "linux:PoBPreviewBot:{} (by /u/aggixx)".format(self.get_git_sha()),
+			# Blocking PRAW calls are always made from executor threads (stream
+			# workers, the reply executor, the ACM pool), never on the event
+			# loop itself, so PRAW's warning about running inside it doesn't
+			# apply.
+			check_for_async = False,
+			requestor_kwargs = {'session': session})
 			
 		logging.info("Successfully logged in as {:s}.".format(config.username))
 			
@@ -145,12 +202,22 @@ class bot_t:
 			next_update_time = min(next_update_time, self.maintain_list.next_time())
 		'''
 			 
-		if len(self.reply_queue) > 0:
+		if self.reply_queue.is_pending():
 			return self.reply_queue.throttled_until() - time.time()
 		
 		return 1e6
 		
-	def run(self):
+	async def main(self):
+		# Post anything replayed from the reply journal before streaming
+		self.reply_queue.process()
+		
+		# Start the ingest coroutines, they share this thread's event loop
+		self.stream_manager.start()
+		
+		while True:
+			await self.run()
+		
+	async def run(self):
 		if config.debug_memory:
 			self.dump_mem_summary()
 	
@@ -161,33 +228,37 @@ class bot_t:
 		# Disable regular maintenance, let ACM take care of things
 		#self.maintain_list.process()
 		
-		# If comments are in queue, then don't update status or sleep, just
-		# return out so we can process them immediately
+		# If comments are in queue or being rendered, then don't update status
+		# or sleep, just yield to the workers and return out so we can
+		# process the rest as soon as one of them frees up
 		if len(self.stream_manager) > 0:
+			await self.stream_manager.wait(max(0, self.get_sleep_time()))
 			return
 		
 		# Do a status update, but only if the backlog is totally resolved.
 		# Often, the stream queue will be empty but the backlog hasn't really
 		# finished being processed so we aren't actually done updating.
 		if not self.is_backlogged():
+			if not self.steady:
+				self.steady = True
+				logging.info("Reached steady state {:.3f}s after start.".format(time.time() - self.start_time))
+			
 			status.update()
 			
 		# calculate the next time we need to do something
 		st = self.get_sleep_time()
 		
 		if st > 0:
-			# Put the thread to sleep, timing out after st seconds or breaking
-			# out immediately if the stream manager notifies of a new entry
+			# Suspend the main coroutine, timing out after st seconds or
+			# resuming immediately if the ingest coroutines queue a new entry
 			logging.debug("Main thread idling for {:.3f}s or until notified".format(st))
 			
-			# reset the event's status
-			self.stream_event.clear()
 			# signal the ACM subthread that it can start maintaining comments
 			self.acm_event.set()
 			logging.debug("Main thread triggers acm_event.")
-			# make this thread wait until a stream subthread signals this
-			# thread to go, or until sleep time has elapsed
-			self.stream_event.wait(timeout=st)
+			# the ingest coroutines keep running on the event loop while we
+			# wait here for one of them to hand over an object
+			await self.stream_manager.wait(st)
 			
 			# operation has continued, so clear the ACM flag so the subthread
 			# knows to stop at the next reasonable stopping point
@@ -195,8 +266,8 @@ class bot_t:
 			logging.debug("Main thread clears acm_event.")
 			
 	@staticmethod	
-	def get_response( object ):
-		return response.get_response( object )
+	def get_response( object, max_importers=None ):
+		return response.get_response( object, max_importers=max_importers )
 		
 	def dump_mem_summary(self):
 		if hasattr(self, 'last_mem_dump') and time.time() < self.last_mem_dump + 60:
@@ -210,16 +281,18 @@ class bot_t:
 			
 		# ---
 		
-		logging.debug("bot={}b replied_to={} maintain.list={} maintain.rlist={} rq.queue={} sm.list={} sm.processed={}".format(
+		logging.debug("bot={}b replied_to={} maintain.list={} maintain.archived={} rq.queue={} sm.queue={} sm.processed={}".format(
 			asizeof.asizeof(self),
 			asizeof.asizeof(self.replied_to),
-			len(self.maintain_list.list),
-			len(self.maintain_list.retired_list),
+			len(self.maintain_list),
+			self.maintain_list.archived,
 			len(self.reply_queue.queue),
-			len(self.stream_manager.list),
-			["{}/{}".format(len(t.processed), asizeof.asizeof(t.processed)) for t in self.stream_manager.threads]
+			len(self.stream_manager),
+			["{}/{}".format(len(l.processed), l.processed.nbytes()) for l in self.stream_manager.listings]
 		))
 		
+		logging.debug(str(self.maintain_list.lock))
+		
 	
 # END FUNCTION DEFINITION
 # =============================================================================
@@ -227,10 +300,9 @@ class bot_t:
 
 try:
 	bot = bot_t()
-	logging.info("Scanning subreddits {}...".format(config.subreddits))
+	logging.info("Scanning subreddits {}...".format(bot.subreddits))
 	
-	while True:
-		bot.run()
+	asyncio.run(bot.main())
 # If ANY unhandled exception occurs, catch it, log it, THEN crash.
 except BaseException:
 	logging.exception("Fatal error occurred.")
@@ -0,0 +1,142 @@
+# Python
+import bisect
+import logging
+
+# 3rd Party
+# Self
+
+# =============================================================================
+
+'''
+Learned maintenance intervals.
+
+Every maintenance check is recorded as an observation: the stretch of the
+reply's life it covered (from the previous check to this one) and whether
+the parent was edited or deleted in that stretch. From those the model
+estimates the hazard, the rate at which parents get edited or deleted, for
+each age bin. Subreddits and authors get a multiplier for how much more or
+less often their parents change than the bins predict, pulled towards 1
+until there is enough data on them.
+
+A check is due once the expected number of changes since the last one
+reaches the target, so the rate budget goes where changes are likely.
+
+The model is fit to counters rather than to the observations themselves:
+seconds of exposure and number of changes per (age bin, subreddit, author),
+which is all the fit needs and grows with the number of authors rather than
+the number of checks.
+'''
+
+# upper edges of the age bins in seconds, the last bin is open ended
+AGE_BINS = [900, 3600, 14400, 86400, 604800, 2592000]
+
+def get_bin(age):
+	return bisect.bisect_right(AGE_BINS, age)
+
+def get_overlap(lo, hi, bin):
+	start = AGE_BINS[bin - 1] if bin > 0 else 0
+	end = AGE_BINS[bin] if bin < len(AGE_BINS) else float('inf')
+
+	return max(0, min(hi, end) - max(lo, start))
+
+'''
+Adds observations up into counters, {(bin, subreddit, author): [exposure,
+events]}. Observations are (subreddit, author, from_age, to_age, kind,
+event_age), kind being 'none', 'edit' or 'delete'.
+'''
+def count(rows):
+	counters = {}
+
+	def get(key):
+		if key not in counters:
+			counters[key] = [0.0, 0]
+
+		return counters[key]
+
+	for subreddit, author, from_age, to_age, kind, event_age in rows:
+		for bin in range(get_bin(from_age), get_bin(to_age) + 1):
+			get((bin, subreddit, author))[0] += get_overlap(from_age, to_age, bin)
+
+		if kind != 'none':
+			get((get_bin(event_age), subreddit, author))[1] += 1
+
+	return counters
+
+class hazard_model_t:
+	def __init__(self, settings):
+		self.settings = settings
+		self.fit([])
+
+	def __str__(self):
+		return "hazard model ({} events, {} groups)".format(self.total_events, len(self.groups))
+
+	def is_ready(self):
+		return self.total_events >= self.settings['min_events']
+
+	'''
+	counters are (bin, subreddit, author, exposure, events), see count().
+	The same key may appear more than once, the counters are added up.
+	'''
+	def fit(self, counters):
+		counters = list(counters)
+		bins = len(AGE_BINS) + 1
+		self.events = [0] * bins
+		self.exposure = [0.0] * bins
+
+		for bin, subreddit, author, exposure, events in counters:
+			self.exposure[bin] += exposure
+			self.events[bin] += events
+
+		self.total_events = sum(self.events)
+		total_exposure = sum(self.exposure)
+		self.global_rate = self.total_events / total_exposure if total_exposure > 0 else 0
+
+		# second pass, events seen against events the bins predict for each
+		# subreddit and author
+		self.groups = {}
+
+		for bin, subreddit, author, exposure, events in counters:
+			expected = self.get_rate(bin) * exposure
+
+			for key in (('subreddit', subreddit), ('author', author)):
+				if key[1] is None:
+					continue
+
+				if key not in self.groups:
+					self.groups[key] = [0, 0.0]
+
+				self.groups[key][0] += events
+				self.groups[key][1] += expected
+
+		logging.debug("Fit {} to {} counters.".format(self, len(counters)))
+
+	# Smoothed changes per second for an age bin, pulled towards the overall
+	# rate when the bin has little exposure
+	def get_rate(self, bin):
+		k = self.settings['prior_exposure']
+
+		return (self.events[bin] + k * self.global_rate) / (self.exposure[bin] + k)
+
+	def get_multiplier(self, kind, name):
+		if name is None or (kind, name) not in self.groups:
+			return 1.0
+
+		events, expected = self.groups[(kind, name)]
+		a = self.settings['prior_events']
+
+		return (events + a) / (expected + a)
+
+	def get_interval(self, age, subreddit=None, author=None, target=None):
+		if target is None:
+			target = self.settings['target']
+
+		rate = self.get_rate(get_bin(age))
+		rate *= self.get_multiplier('subreddit', subreddit)
+		rate *= self.get_multiplier('author', author)
+
+		if rate > 0:
+			interval = target / rate
+		else:
+			interval = self.settings['max_interval']
+
+		return min(max(interval, self.settings['min_interval']), self.settings['max_interval'])
@@ -0,0 +1,106 @@
+# Python
+import os
+import time
+import types
+import shutil
+import logging
+import tempfile
+import unittest
+
+# 3rd Party
+import praw
+
+# Self
+from config import config_helper as config
+config.set_mode("debug") # must set before importing other modules
+from comment_maintenance import maintain_list_t, entry_t
+from info_source import local_info_source_t, BATCH_SIZE
+from state_store import state_store_t
+
+logging.root.setLevel(logging.WARNING)
+
+'''
+Offline tests for comment maintenance. Objects are served by
+local_info_source_t, which counts /api/info requests without making any.
+
+usage:
+	python maintenance_test.py
+'''
+
+class refresh_batch_test_t(unittest.TestCase):
+	def setUp(self):
+		# no ACM thread, entries are only refreshed when the test asks
+		config.settings['aggressive_maintenance_utilization'] = 0
+
+		self.dir = tempfile.mkdtemp()
+		self.reddit = praw.Reddit(client_id='test', client_secret='test', user_agent='PoBPreviewBot maintenance test')
+		self.info = local_info_source_t()
+
+		bot = types.SimpleNamespace(
+			store=state_store_t(os.path.join(self.dir, "state.db")),
+			reddit=self.reddit,
+			replied_to=None,
+		)
+
+		self.list = maintain_list_t(bot, os.path.join(self.dir, "active_comments.json"), info=self.info)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	# Adds n replies to the list, every other one to a submission and the rest
+	# to comments. Returns their entries.
+	def add_replies(self, n, known_parents=True):
+		now = time.time()
+		entries = []
+
+		for i in range(n):
+			if i % 2 == 0:
+				parent = praw.models.Submission(self.reddit, _data={'id': 's{}'.format(i)})
+			else:
+				parent = praw.models.Comment(self.reddit, _data={'id': 'p{}'.format(i), 'link_id': 't3_s0', 'parent_id': 't3_s0'})
+
+			comment = praw.models.Comment(self.reddit, _data={'id': 'c{}'.format(i), 'link_id': 't3_s0', 'parent_id': parent.fullname})
+
+			self.info.add(parent)
+			self.info.add(comment)
+
+			entry = entry_t(self.list, {
+				'comment_id': comment.id,
+				'created_utc': now - 3600,
+				'parent_id': parent.fullname if known_parents else None,
+			})
+			self.list.add_entry(entry)
+			entries.append(entry)
+
+		return entries
+
+	def test_known_parents(self):
+		entries = self.add_replies(50)
+
+		refreshed = self.list.refresh_batch(entries)
+
+		self.assertEqual(len(refreshed), 50)
+		# 50 replies and 50 parents fit in one request
+		self.assertEqual(self.info.requests, 1)
+		self.assertEqual(sum(1 for e in refreshed if e.parent.fullname.startswith('t3_')), 25)
+
+	def test_unknown_parents(self):
+		entries = self.add_replies(50, known_parents=False)
+
+		refreshed = self.list.refresh_batch(entries)
+
+		self.assertEqual(len(refreshed), 50)
+		# the replies first, then the parents they point to
+		self.assertEqual(self.info.requests, 2)
+		self.assertTrue(all(e.parent_id == e.parent.fullname for e in refreshed))
+
+	def test_large_batch(self):
+		entries = self.add_replies(2 * BATCH_SIZE)
+
+		refreshed = self.list.refresh_batch(entries)
+
+		self.assertEqual(len(refreshed), 2 * BATCH_SIZE)
+		self.assertEqual(self.info.requests, 4)
+
+if __name__ == '__main__':
+	unittest.main()
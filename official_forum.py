@@ -2,6 +2,7 @@
 import re
 import time
 import logging
+import threading
 
 # 3rd Party
 import urllib.request, urllib.error, urllib.parse
@@ -16,6 +17,8 @@ from config import config_helper as config
 soup_cache = None
 cache_time = 0
 cache_url = None
+# objects are rendered on several threads at once
+cache_lock = threading.Lock()
 
 def is_post( url ):
 	if re.match("^https?://www\.pathofexile\.com/forum/view-thread/\d+/?$", url):
@@ -28,18 +31,19 @@ def get_soup_from_url( url ):
 	global cache_time
 	global soup_cache
 	
-	if url != cache_url or time.time() > cache_time + 5:
-		try:
-			html = util.get_url_data(url)
-		except urllib.error.URLError as e:
-			logging.error("Failed to retrieve any data\n{}\n{}".format(url, str(e)))
-			return None
+	with cache_lock:
+		if url != cache_url or time.time() > cache_time + 5:
+			try:
+				html = util.get_url_data(url)
+			except urllib.error.URLError as e:
+				logging.error("Failed to retrieve any data\n{}\n{}".format(url, str(e)))
+				return None
+				
+			soup_cache = BeautifulSoup(html, 'html.parser')
+			cache_time = time.time()
+			cache_url = url
 			
-		soup_cache = BeautifulSoup(html, 'html.parser')
-		cache_time = time.time()
-		cache_url = url
-		
-	return soup_cache
+		return soup_cache
 	
 def get_op_body( url ):
 	soup = get_soup_from_url( url )
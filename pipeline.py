@@ -0,0 +1,243 @@
+# Python
+import asyncio
+import logging
+import os
+import time
+
+# 3rd Party
+
+# Self
+import util
+from config import config_helper as config
+from praw_wrapper import praw_object_wrapper_t
+from comment_maintenance import entry_t
+from reddit_stream import stream_manager_t
+from durable_queue import durable_queue_t
+
+# =============================================================================
+
+'''
+Pipeline mode splits the bot into three processes per shard:
+
+	ingest  streams and backlogs the subreddits, filters, and queues the
+	        fullnames of anything worth rendering
+	render  fetches queued objects, renders them, and queues the replies
+	post    posts queued replies, and runs comment maintenance
+
+The stages are connected by durable queues in the state store, so a stage can
+be restarted, or fall behind, without losing work or stalling the others.
+Every item is leased until the next stage acks it, anything a dead process
+was holding is picked up again once its lease runs out.
+
+Only one post process should run per shard, reply claims are per shard.
+'''
+
+STAGES = ('all', 'ingest', 'render', 'post')
+
+# Every shard has its own queues in the shared store, so items are only
+# rendered, posted and maintained by the shard that ingested them
+def get_queue(bot, stage):
+	return durable_queue_t(bot.store, "{}.{}".format(stage, bot.shard))
+
+class durable_reply_sink_t:
+	'''
+	Stands in for the reply handler in the ingest and render stages, replies
+	are handed on to the post stage instead of being posted.
+	'''
+
+	def __init__(self, bot):
+		self.queue = get_queue(bot, 'post')
+
+	def reply(self, object, message_body, log = True):
+		# the object is loaded here, unlike in the post stage
+		self.queue.put({
+			'fullname': object.fullname,
+			'subreddit': str(object.subreddit).lower(),
+			'fingerprint': entry_t.get_fingerprint(object) if log else None,
+			'body': message_body,
+			'log': log,
+		}, key=object.id)
+
+	def contains_id(self, id):
+		return self.queue.contains_key(id)
+
+	def __len__(self):
+		return 0
+
+	def get_oldest_age(self):
+		return 0
+
+	def throttled_until(self):
+		return 0
+
+	def is_pending(self):
+		return False
+
+	def process(self):
+		pass
+
+class ingest_manager_t(stream_manager_t):
+	'''
+	Runs the ingest coroutines as normal, but objects that get through the
+	filters are queued for the render stage instead of being rendered here.
+	'''
+
+	def __init__(self, bot):
+		super().__init__(bot)
+		self.render_queue = get_queue(bot, 'render')
+
+	def put(self, object, priority, backlog=False):
+		self.render_queue.put({
+			'fullname': object.fullname,
+			'backlog': backlog,
+		}, priority=priority, key=object.id)
+
+	def process(self):
+		pass
+
+class render_manager_t(stream_manager_t):
+	'''
+	Feeds the render pool from the render queue instead of from ingest
+	coroutines. Items are acked once rendered and committed, i.e. once their
+	reply (if any) is in the post queue.
+	'''
+
+	def __init__(self, bot):
+		super().__init__(bot)
+		self.render_queue = get_queue(bot, 'render')
+		# object id -> queue item id
+		self.leased = {}
+
+	def start(self):
+		self.loop = asyncio.get_running_loop()
+		self.queue = asyncio.PriorityQueue()
+		self.changed = asyncio.Event()
+
+		# No ingest here, the feeder takes the place of the listings
+		self.tasks.append(asyncio.ensure_future(self.run()))
+
+	def done(self, object):
+		id = self.leased.pop(object.id, None)
+
+		if id is not None:
+			self.render_queue.ack(id)
+
+	# Runs on an ingest thread, rehydrates a queued fullname
+	def fetch(self, fullname):
+		objects = list(self.reddit.info(fullnames=[fullname]))
+
+		if len(objects) == 0:
+			return None
+
+		return praw_object_wrapper_t(self.bot, objects[0])
+
+	async def run(self):
+		# Exception handler shell
+		try:
+			await self.feed()
+		except asyncio.CancelledError:
+			raise
+		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
+		except BaseException:
+			logging.exception("Fatal error occurred in render feeder coroutine.")
+			os._exit(1)
+			raise
+
+	async def feed(self):
+		while True:
+			self.render_queue.touch(list(self.leased.values()))
+
+			# only lease as much as the pool can work on, the rest stays
+			# available to other render processes
+			item = None
+
+			if len(self) < config.stream_workers:
+				item = await self.loop.run_in_executor(self.executor, self.render_queue.get)
+
+			if item is None:
+				await asyncio.sleep(config.pipeline_poll_interval)
+				continue
+
+			id, payload = item
+
+			await self.bot.budget.wait('stream')
+			object = await self.loop.run_in_executor(self.executor, self.fetch, payload['fullname'])
+
+			if object is None or object.id in self.leased:
+				logging.debug("Dropping render queue item {}.".format(payload['fullname']))
+				self.render_queue.ack(id)
+				continue
+
+			self.leased[object.id] = id
+			self.seq += 1
+			self.queue.put_nowait((self.get_priority(object, payload['backlog']), self.seq, time.time(), payload['backlog'], object))
+			self.notify()
+
+class post_feeder_t:
+	'''
+	Takes the place of the stream manager in the post stage, moves replies
+	from the post queue into the reply handler.
+	'''
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.reddit = bot.reddit
+		self.reply_queue = bot.reply_queue
+		self.post_queue = get_queue(bot, 'post')
+		self.listings = []
+		# object id -> queue item id of replies handed to the reply handler
+		self.pending = {}
+		self.changed = None
+
+	def start(self):
+		self.changed = asyncio.Event()
+
+	def notify(self):
+		self.changed.set()
+
+	def __len__(self):
+		return 0
+
+	def process(self):
+		# ack replies the reply handler is finished with
+		for object_id, id in list(self.pending.items()):
+			if not self.reply_queue.contains_id(object_id):
+				self.post_queue.ack(id)
+				del self.pending[object_id]
+
+		self.post_queue.touch(list(self.pending.values()))
+
+		# Don't pull replies in while throttled, they're safer on disk
+		while not self.reply_queue.throttled():
+			item = self.post_queue.get()
+
+			if item is None:
+				break
+
+			id, payload = item
+			object = praw_object_wrapper_t(self.bot, util.get_praw_object_by_fullname(self.reddit, payload['fullname']))
+
+			if object.id in self.pending:
+				self.post_queue.ack(id)
+				continue
+
+			# may already be queued from the reply journal after a restart. The
+			# object is only a fullname here, the subreddit comes with the
+			# payload so it doesn't have to be fetched.
+			if not self.reply_queue.contains_id(object.id):
+				self.reply_queue.reply(object, payload['body'], log=payload['log'], subreddit=payload.get('subreddit'), fingerprint=payload.get('fingerprint'))
+
+			if self.reply_queue.contains_id(object.id):
+				self.pending[object.id] = id
+			else:
+				self.post_queue.ack(id)
+
+	async def wait(self, timeout):
+		# posts finishing wake this early, new replies are only noticed by
+		# polling the post queue
+		self.changed.clear()
+
+		try:
+			await asyncio.wait_for(self.changed.wait(), timeout=min(timeout, config.pipeline_poll_interval))
+		except asyncio.TimeoutError:
+			pass
@@ -1,6 +1,7 @@
 # Python
 import logging
 import json
+import threading
 from hashlib import md5
 
 # 3rd Party
@@ -20,6 +21,9 @@ headers = {
 
 path = 'save/pob_party.json'
 
+# builds are rendered on several threads at once
+lock = threading.Lock()
+
 try:
 	with open(path, 'r') as f:
 		hashmap = json.load(f)
@@ -44,10 +48,11 @@ def get_url(pobparty):
 		
 		logging.debug("{}'s pob.party token is {}.".format(pobparty, rj['url']))
 		
-		hashmap[hash] = rj['url']
-		
-		with atomic_write(path, overwrite=True) as f:
-			json.dump(hashmap, f, sort_keys=True, indent=4)
+		with lock:
+			hashmap[hash] = rj['url']
+			
+			with atomic_write(path, overwrite=True) as f:
+				json.dump(hashmap, f, sort_keys=True, indent=4)
 		
 	return "https://pob.party/share/{}".format(hashmap[hash])
 
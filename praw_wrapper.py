@@ -80,6 +80,13 @@ class praw_object_wrapper_t():
 			return o.author
 			
 	def parse_and_reply(self, reply_queue):
+		response, log = self.render()
+		
+		return self.commit(reply_queue, response, log)
+		
+	# Build the response for this object. Does all of the network and parsing
+	# work, so it is safe to run on a worker thread.
+	def render(self, max_importers=None):
 		body = self.get_body()
 		author = self.get_author()
 	
@@ -98,7 +105,7 @@ class praw_object_wrapper_t():
 		
 		try:
 			# get response text
-			response = self.bot.get_response( self )
+			response = self.bot.get_response( self, max_importers=max_importers )
 
 			if response:
 				logging.info("Found matching {}.".format(self))
@@ -109,7 +116,12 @@ class praw_object_wrapper_t():
 				response = config.RESPONSE_PROVIDE_REASON.format(str(self), "", "* {}".format(str(e)))
 				log = False
 				logging.info("Providing reason for {}.".format(self))
-			
+				
+		return response, log
+		
+	# Post a rendered response. Must be called from the thread that owns the
+	# reply queue.
+	def commit(self, reply_queue, response, log):
 		if response is None:
 			return False
 		
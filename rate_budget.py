@@ -0,0 +1,221 @@
+# Python
+import asyncio
+import heapq
+import threading
+import logging
+import time
+import os
+
+# 3rd Party
+# Self
+from config import config_helper as config
+
+# =============================================================================
+
+'''
+One budget for every request the bot makes to reddit.
+
+reddit allows so many requests per rate limit window and reports what is left
+of it in the x-ratelimit-* headers of every response. The budget spreads what
+is left evenly over the rest of the window as a token bucket, and hands the
+tokens out by priority: replies first, then live stream polls, then the
+backlog, then comment maintenance. A class only takes tokens while the bucket
+holds more than its reserve, so the lower classes always leave something for
+a burst of the higher ones.
+
+Requests that weren't reserved still show up in the headers, so the pace
+corrects itself after every response.
+
+Consumers block, or await, until they're granted their tokens and are woken
+as soon as they are, either by whoever frees up budget or by the dispatcher
+thread once the bucket has refilled.
+'''
+
+PRIORITIES = ('reply', 'stream', 'backlog', 'maintenance')
+
+class rate_budget_t:
+	def __init__(self):
+		self.settings = config.rate_budget
+
+		# what the last response said is left of the window
+		self.remaining = None
+		self.reset_timestamp = None
+
+		self.tokens = float(self.settings['burst'])
+		self.last_refill = time.time()
+
+		# heap of (priority, seq, cost, wake) of everyone waiting for tokens
+		self.waiters = []
+		self.seq = 0
+		# tokens granted per priority class
+		self.granted = [0] * len(PRIORITIES)
+
+		self.cond = threading.Condition()
+
+	def __str__(self):
+		return "rate budget ({:.1f} tokens, {} remaining, {} waiting)".format(self.tokens, self.remaining, len(self.waiters))
+
+	def start(self):
+		thread = threading.Thread(target=self.run, name='RateBudget')
+		thread.daemon = True
+		thread.start()
+
+	# Response hook for the requests session PRAW uses
+	def __call__(self, response, *args, **kwargs):
+		headers = response.headers
+
+		if 'x-ratelimit-remaining' not in headers or 'x-ratelimit-reset' not in headers:
+			return
+
+		with self.cond:
+			now = time.time()
+			self.refill(now)
+
+			self.remaining = float(headers['x-ratelimit-remaining'])
+			self.reset_timestamp = now + float(headers['x-ratelimit-reset'])
+
+			self.dispatch()
+			self.cond.notify()
+
+	# Requests per second the rest of the window allows
+	def get_rate(self, now=None):
+		if now is None:
+			now = time.time()
+
+		# nothing reported yet, or the window has run out without a new one
+		# being reported
+		if self.remaining is None or now >= self.reset_timestamp:
+			return self.settings['default_rate']
+
+		return max(self.remaining - self.settings['spare'], 0) / max(self.reset_timestamp - now, 1)
+
+	def refill(self, now):
+		self.tokens = min(self.settings['burst'], self.tokens + self.get_rate(now) * (now - self.last_refill))
+		self.last_refill = now
+
+	# Tokens the bucket has to hold before cost can be granted to priority.
+	# Never more than the bucket holds, or a large reservation could never be
+	# granted, it goes into debt instead.
+	def get_required(self, priority, cost):
+		return min(cost + self.settings['reserve'][PRIORITIES[priority]], self.settings['burst'])
+
+	# Grants tokens to waiters in priority order, a waiter that can't be
+	# granted yet holds back everyone behind it
+	def dispatch(self):
+		while len(self.waiters) > 0:
+			priority, seq, cost, wake = self.waiters[0]
+
+			if self.tokens < self.get_required(priority, cost):
+				break
+
+			heapq.heappop(self.waiters)
+			self.tokens -= cost
+			self.granted[priority] += cost
+
+			# counted against the window until the next response says otherwise
+			if self.remaining is not None:
+				self.remaining = max(self.remaining - cost, 0)
+
+			wake()
+
+	# Seconds until the first waiter can be granted
+	def get_wait_time(self, now):
+		if len(self.waiters) == 0:
+			return None
+
+		priority, seq, cost, wake = self.waiters[0]
+		deficit = self.get_required(priority, cost) - self.tokens
+		rate = self.get_rate(now)
+
+		# the rate changes once the window resets
+		until_reset = self.reset_timestamp - now if self.reset_timestamp is not None and self.reset_timestamp > now else None
+
+		if rate <= 0:
+			return until_reset
+
+		t = deficit / rate
+
+		if until_reset is not None:
+			t = min(t, until_reset)
+
+		return max(t, 0.001)
+
+	def enqueue(self, name, cost, wake):
+		with self.cond:
+			self.seq += 1
+			waiter = (PRIORITIES.index(name), self.seq, cost, wake)
+			heapq.heappush(self.waiters, waiter)
+
+			self.refill(time.time())
+			self.dispatch()
+			self.cond.notify()
+
+		return waiter
+
+	def cancel(self, waiter):
+		with self.cond:
+			if waiter in self.waiters:
+				self.waiters.remove(waiter)
+				heapq.heapify(self.waiters)
+				self.dispatch()
+				self.cond.notify()
+
+	# Blocks until cost tokens have been granted to the named class
+	def acquire(self, name, cost=1):
+		event = threading.Event()
+		waiter = self.enqueue(name, cost, event.set)
+
+		try:
+			event.wait()
+		except BaseException:
+			self.cancel(waiter)
+			raise
+
+	# Coroutine version of acquire()
+	async def wait(self, name, cost=1):
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+
+		def set_result():
+			if not future.done():
+				future.set_result(None)
+
+		waiter = self.enqueue(name, cost, lambda: loop.call_soon_threadsafe(set_result))
+
+		try:
+			await future
+		except asyncio.CancelledError:
+			self.cancel(waiter)
+			raise
+
+	# Hands back tokens that were granted but not spent
+	def refund(self, cost):
+		with self.cond:
+			self.tokens = min(self.settings['burst'], self.tokens + cost)
+
+			if self.remaining is not None:
+				self.remaining += cost
+
+			self.dispatch()
+			self.cond.notify()
+
+	def run(self):
+		# Exception handler shell
+		try:
+			self.main()
+		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
+		except BaseException:
+			logging.exception("Fatal error occurred in rate budget thread.")
+			os._exit(1)
+			raise
+
+	def main(self):
+		logging.debug("Started rate budget thread.")
+
+		with self.cond:
+			while True:
+				now = time.time()
+				self.refill(now)
+				self.dispatch()
+
+				self.cond.wait(self.get_wait_time(now))
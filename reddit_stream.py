@@ -1,166 +1,657 @@
 # Python
-import _thread
-import threading
+import asyncio
+import concurrent.futures
 import logging
 import os
 import time
 import datetime
 import math
+import re
 
 # 3rd Party
 import praw
-from retrying import retry
 
 # Self
 import util
-import official_forum
 from config import config_helper as config
 import status
 import logger
+import official_forum
 from praw_wrapper import praw_object_wrapper_t
-from response import get_response
-from response import reply_to_summon
+from dedup_set import dedup_set_t
+import importers
+from response import render_summon
+from response import commit_summon
+
+class stream_filter_t:
+	'''
+	Pre-filter run on the raw listing data of every streamed object before it
+	is wrapped or queued. Almost nothing that comes through the stream links
+	a build, and wrapping those objects costs a queue slot, a pass through
+	get_response and potentially lazy PRAW fetches, so they are dropped here
+	with a single regex scan over the text the listing already contains.
+	'''
+
+	# seconds between counter summaries in the log
+	log_interval = 3600
+
+	def __init__(self):
+		self.pattern = re.compile(r'pastebin\.com/|pob\.party/share/|u/{}'.format(re.escape(config.username)), re.IGNORECASE)
+		self.link_pattern = re.compile(r'pastebin\.com/|pob\.party/share/', re.IGNORECASE)
+		self.summon_pattern = re.compile(r'u/{}'.format(re.escape(config.username)), re.IGNORECASE)
+
+		# subreddit -> [passed, filtered]
+		self.counts = {}
+		self.last_log = time.time()
+
+	@staticmethod
+	def get_raw_text(object):
+		# read straight from the instance dict, attribute access on a PRAW
+		# object that lacks the attribute triggers a fetch
+		d = vars(object)
+
+		if isinstance(object, praw.models.Comment):
+			return d.get('body') or ''
+
+		return "{}\n{}".format(d.get('selftext') or '', d.get('url') or '')
+
+	@staticmethod
+	def is_forum_post(object):
+		# official forum posts only reveal their links once the thread is scraped
+		d = vars(object)
+
+		return isinstance(object, praw.models.Submission) and not d.get('selftext') and official_forum.is_post(d.get('url') or '')
+
+	def accepts(self, object):
+		accepted = self.is_forum_post(object) or self.pattern.search(self.get_raw_text(object)) is not None
+
+		subreddit = str(vars(object).get('subreddit'))
+
+		if subreddit not in self.counts:
+			self.counts[subreddit] = [0, 0]
+
+		self.counts[subreddit][0 if accepted else 1] += 1
+
+		if time.time() - self.last_log >= stream_filter_t.log_interval:
+			self.log_summary()
+
+		return accepted
+
+	def is_summon(self, object):
+		return isinstance(object, praw.models.Comment) and self.summon_pattern.search(self.get_raw_text(object)) is not None
+
+	def has_links(self, object):
+		return self.is_forum_post(object) or self.link_pattern.search(self.get_raw_text(object)) is not None
+
+	def log_summary(self):
+		for subreddit, (passed, filtered) in sorted(self.counts.items()):
+			logging.info("Stream filter r/{}: passed {}, filtered {} ({:.1f}%).".format(
+				subreddit,
+				passed,
+				filtered,
+				100.0 * filtered / max(passed + filtered, 1)
+			))
+
+		self.last_log = time.time()
+
+class stream_listing_t:
+	'''
+	Ingests a single listing (comments or submissions). The backlog is pulled
+	by the listing's own coroutine, after that it is polled by the manager's
+	poll_scheduler_t.
+
+	PRAW is synchronous, so every call that may hit the network is pushed onto
+	the manager's executor and awaited, leaving the event loop free to run the
+	other listing and the processing stage in the meantime.
+	'''
+
+	# objects per listing request, reddit's maximum
+	page_size = 100
 
-class stream_thread_t(threading.Thread):
 	def __init__(self, manager, type):
-		threading.Thread.__init__(self, name="{}Thread".format(type))
-		
-		if not hasattr(manager.subreddit.stream, type):
-			raise ValueError("stream_thread_t was passed invalid type")
+		if type not in ('comments', 'submissions'):
+			raise ValueError("stream_listing_t was passed invalid type")
 
 		self.manager = manager
 		self.type = type
-		self.handler = getattr(manager.subreddit.stream, type)
-		self.processed = {}
-		
-		logging.debug("Created {} daemon thread.".format(self.type))
-				
+		self.handler = getattr(manager.subreddit, 'new' if type == 'submissions' else 'comments')
+
+		# Polling state, see poll_scheduler_t. The cursor is the newest object
+		# seen, polls only ask for what came after it.
+		self.cursor = None
+		self.cursor_time = time.time()
+		self.last_poll = None
+		self.due = 0
+		self.errors = 0
+		# smoothed objects per second for each hour of the day (UTC)
+		self.rates = status.get_poll_rates(type) or [None] * 24
+		# IDs older than the backlog window can never be listed again, so
+		# there's no need to remember them any longer than that
+		self.processed = dedup_set_t(config.backlog_time_limit, bloom=config.stream_dedup_bloom)
+
+		logging.debug("Created {} ingest coroutine.".format(self.type))
+
 	def get_backlog_window(self):
+		checkpoint = status.get_checkpoint(self.type)
+
+		# the checkpoint is exact, lastUpdate misses objects that show up in
+		# the listing some time after their creation
+		if checkpoint is not None:
+			return max(checkpoint['created_utc'], time.time() - config.backlog_time_limit)
+
 		return max(status.get_last_update(), time.time() - config.backlog_time_limit)
-			
-	@retry(retry_on_exception=util.is_praw_error,
-		   wait_exponential_multiplier=config.praw_error_wait_time,
-		   wait_func=util.praw_error_retry)
-	def check_and_queue(self, object):
-		logging.log(logger.DEBUG_ALL, "{} daemon thread found {}.".format(self.type, object))
-		
-		if object.id in self.processed:
+
+	def update_checkpoint(self, object):
+		checkpoint = status.get_checkpoint(self.type)
+
+		if checkpoint is None or object.created_utc > checkpoint['created_utc']:
+			status.set_checkpoint(self.type, object.fullname, object.created_utc)
+
+	async def call(self, func, *args):
+		return await self.manager.loop.run_in_executor(self.manager.executor, func, *args)
+
+	async def retry(self, func, *args):
+		# Coroutine equivalent of the @retry(util.is_praw_error) decorator.
+		# Backing off only suspends this coroutine instead of the thread.
+		attempt = 0
+
+		while True:
+			try:
+				return await func(*args)
+			except util.praw_errors as e:
+				util.is_praw_error(e)
+				attempt += 1
+				await asyncio.sleep(util.praw_error_retry(attempt, 0) / 1000)
+
+	def check_and_queue(self, object, backlog=False):
+		logging.log(logger.DEBUG_ALL, "{} ingest found {}.".format(self.type, object))
+
+		self.update_checkpoint(object)
+
+		if self.processed.contains(object.id):
 			logging.debug("{} has already been processed.".format(object))
 			return
-			
+
+		if not self.manager.filter.accepts(object):
+			logging.log(logger.DEBUG_ALL, "{} has no build links or summons, dropping.".format(object))
+			self.processed.add(object.id)
+			return
+
 		if self.manager.bot.replied_to.contains(object):
 			logging.debug("{} has already been replied to.".format(object))
-			self.processed[object.id] = True
+			self.processed.add(object.id)
 			return
-		
+
 		wrapped = praw_object_wrapper_t(self.manager.bot, object)
-			
-		self.manager.list.append(wrapped)
-		self.processed[object.id] = True
-		logging.debug("Added {} to stream queue (len={}).".format(wrapped, len(self.manager.list)))
-		
-		if not self.manager.bot.stream_event.is_set():
-			# Notify the main thread to wake up so it can process the new entry
-			self.manager.bot.stream_event.set()
-			logging.debug("{} thread notified main thread".format(self.type))
-				
-	@retry(retry_on_exception=util.is_praw_error,
-		   wait_exponential_multiplier=config.praw_error_wait_time,
-		   wait_func=util.praw_error_retry)	
-	def do_backlog(self, since):
-		
-		# Grab comments
-		backlogged = getattr(self.manager.subreddit, 'new' if self.type == 'submissions' else 'comments')
+
+		self.manager.put(wrapped, self.manager.get_priority(object, backlog), backlog)
+		self.processed.add(object.id)
+		logging.debug("Added {} to stream queue (len={}).".format(wrapped, len(self.manager)))
+
+	# stop_at is the checkpoint from before the backlog started. Queuing
+	# objects moves the checkpoint on, so a retry after an error must not
+	# read it again or it would stop at the newest object.
+	async def do_backlog(self, since, stop_at):
 		count = 0
-		
+		start = time.time()
+
 		# Docs say that no limit may be limited to 1000 objects anyway.
 		# https://praw.readthedocs.io/en/latest/code_overview/other/listinggenerator.html#praw.models.ListingGenerator
-		for object in backlogged(limit=None):
-			if object.created_utc < since:
+		listing = self.handler(limit=None)
+
+		while True:
+			# the listing fetches a page at a time
+			if count % stream_listing_t.page_size == 0:
+				await self.manager.bot.budget.wait('backlog')
+
+			object = await self.call(next, listing, None)
+
+			# everything from the checkpoint back was handled by the last run
+			if object is None or object.created_utc < since or object.fullname == stop_at:
 				# flag backlog as resolved in bot state
 				self.manager.bot.backlog[self.type] = False
-				logging.info("Completed pulling {} backlog, checked {} {}.".format(self.type, count, self.type))
+				logging.info("Completed pulling {} backlog, checked {} {} in {:.3f}s{}.".format(
+					self.type,
+					count,
+					self.type,
+					time.time() - start,
+					" (resumed from {})".format(stop_at) if object is not None and object.fullname == stop_at else ""
+				))
 				return
-				
+
 			count = count + 1;
-			
-			self.check_and_queue(object)
-			
-	@retry(retry_on_exception=util.is_praw_error,
-		   wait_exponential_multiplier=config.praw_error_wait_time,
-		   wait_func=util.praw_error_retry)	
-	def do_stream(self):
-		for object in self.handler():
+
+			self.check_and_queue(object, backlog=True)
+
+	# Runs on an ingest thread. Fetches one page of whatever was posted after
+	# the cursor, newest first.
+	def fetch_new(self):
+		params = {'limit': stream_listing_t.page_size}
+
+		if self.cursor is not None:
+			params['before'] = self.cursor
+
+		return list(self.manager.reddit.get(self.handler().url, params=params))
+
+	async def poll(self):
+		await self.manager.bot.budget.wait('stream')
+		objects = await self.call(self.fetch_new)
+		now = time.time()
+
+		if len(objects) == 0 and self.is_cursor_stale(now):
+			# Listings return nothing before a cursor that has since been
+			# removed, so fetch the front of the listing again right away.
+			# Anything already seen is caught by the dedup set.
+			logging.info("{} cursor {} returned nothing, retrying without it.".format(self.type, self.cursor))
+			self.cursor = None
+
+			await self.manager.bot.budget.wait('stream')
+			objects = await self.call(self.fetch_new)
+			now = time.time()
+
+		if len(objects) > 0:
+			self.cursor = objects[0].fullname
+			self.cursor_time = now
+
+		for object in reversed(objects):
 			self.check_and_queue(object)
 
-	def run(self):
+		self.observe(len(objects), now)
+
+		return len(objects) >= stream_listing_t.page_size
+
+	# Whether an empty poll with the cursor is more likely down to the cursor
+	# having been removed than to nothing having been posted, either because
+	# the learned rate says something should have been or because it's been
+	# quiet for too long
+	def is_cursor_stale(self, now):
+		if self.cursor is None:
+			return False
+
+		if now - self.cursor_time > config.stream_polling['cursor_timeout']:
+			return True
+
+		rate = self.get_rate(now)
+
+		return rate is not None and self.last_poll is not None and rate * (now - self.last_poll) >= 1
+
+	def observe(self, count, now):
+		if self.last_poll is not None and now > self.last_poll:
+			hour = datetime.datetime.utcfromtimestamp(now).hour
+			rate = count / (now - self.last_poll)
+			alpha = config.stream_polling['smoothing']
+
+			if self.rates[hour] is None:
+				self.rates[hour] = rate
+			else:
+				self.rates[hour] = alpha * rate + (1 - alpha) * self.rates[hour]
+
+			status.set_poll_rates(self.type, self.rates)
+
+		self.last_poll = now
+
+	# Expected objects per second at this time of day
+	def get_rate(self, now):
+		rate = self.rates[datetime.datetime.utcfromtimestamp(now).hour]
+
+		if rate is not None:
+			return rate
+
+		known = [r for r in self.rates if r is not None]
+
+		if len(known) == 0:
+			return None
+
+		return sum(known) / len(known)
+
+	async def run(self):
 		# Exception handler shell
 		try:
-			self.main()
+			await self.main()
+		except asyncio.CancelledError:
+			raise
 		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
 		except BaseException:
-			logging.exception("Fatal error occurred in {} thread.".format(self.type))
-			_thread.interrupt_main()
+			logging.exception("Fatal error occurred in {} ingest coroutine.".format(self.type))
 			os._exit(1)
 			raise
-			
-	def main(self):
-		logging.debug("Started {} daemon thread.".format(self.type))
-		
+
+	async def main(self):
+		logging.debug("Started {} ingest coroutine.".format(self.type))
+
 		since = self.get_backlog_window()
 		logging.info("Pulling {} since [{}]...".format(
 			self.type,
 			datetime.datetime.fromtimestamp(math.floor(since))
 		))
-		self.do_backlog(since)
-		
-		self.do_stream()
+
+		checkpoint = status.get_checkpoint(self.type)
+		stop_at = checkpoint['fullname'] if checkpoint is not None else None
+
+		await self.retry(self.do_backlog, since, stop_at)
+
+		checkpoint = status.get_checkpoint(self.type)
+		self.cursor = checkpoint['fullname'] if checkpoint is not None else None
+
+		self.manager.scheduler.add(self)
+
+class poll_scheduler_t:
+	'''
+	Polls every stream listing from a single coroutine.
+
+	Each listing is polled about as often as it takes for a handful of new
+	objects to show up, going by its observed post rate at this hour of the
+	day, so quiet listings and quiet hours use fewer requests. A full page
+	means the listing is behind and it is polled again straight away. On top
+	of that polling is held to a share of the remaining rate limit budget,
+	leaving the rest for replies and comment maintenance.
+	'''
+
+	def __init__(self, manager):
+		self.manager = manager
+		self.listings = []
+		self.changed = asyncio.Event()
+
+	def add(self, listing):
+		listing.due = time.time()
+		self.listings.append(listing)
+		self.changed.set()
+
+		logging.debug("Scheduling {} polls.".format(listing.type))
+
+	# Shortest interval between polls of one listing that keeps polling within
+	# its share of the rate limit budget
+	def get_budget_interval(self):
+		rate = self.manager.bot.budget.get_rate() * config.stream_polling['budget_share']
+
+		if rate <= 0:
+			return config.stream_polling['max_interval']
+
+		return len(self.listings) / rate
+
+	def get_interval(self, listing, now):
+		settings = config.stream_polling
+		rate = listing.get_rate(now)
+
+		if rate is None or rate <= 0:
+			interval = settings['max_interval'] if rate is not None else settings['min_interval']
+		else:
+			interval = settings['target_items'] / rate
+
+		interval = min(max(interval, settings['min_interval']), settings['max_interval'])
+
+		return max(interval, self.get_budget_interval())
+
+	async def run(self):
+		# Exception handler shell
+		try:
+			await self.main()
+		except asyncio.CancelledError:
+			raise
+		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
+		except BaseException:
+			logging.exception("Fatal error occurred in poll scheduler coroutine.")
+			os._exit(1)
+			raise
+
+	async def main(self):
+		while True:
+			self.changed.clear()
+
+			if len(self.listings) == 0:
+				await self.changed.wait()
+				continue
+
+			listing = min(self.listings, key=lambda l: l.due)
+			delay = listing.due - time.time()
+
+			# wake early if another listing gets added
+			if delay > 0:
+				try:
+					await asyncio.wait_for(self.changed.wait(), timeout=delay)
+				except asyncio.TimeoutError:
+					pass
+
+				continue
+
+			try:
+				full = await listing.poll()
+				listing.errors = 0
+			except util.praw_errors as e:
+				util.is_praw_error(e)
+				listing.errors += 1
+				listing.due = time.time() + util.praw_error_retry(listing.errors, 0) / 1000
+				continue
+
+			now = time.time()
+			interval = 0 if full else self.get_interval(listing, now)
+			listing.due = now + interval
+
+			logging.log(logger.DEBUG_ALL, "Next {} poll in {:.1f}s.".format(listing.type, interval))
 
 class stream_manager_t:
 	def __init__(self, bot):
 		self.bot = bot
 		self.reddit = bot.reddit
-		self.subreddit_str = "+".join(config.subreddits)
+		self.subreddit_str = "+".join(bot.subreddits)
 		self.subreddit = self.reddit.subreddit(self.subreddit_str)
 		self.reply_queue = bot.reply_queue
-		
-		self.list = []
-		self.threads = []
-		
-		self.__init_threads__()
-		
-	def __init_threads__(self):
-		self.threads.append(stream_thread_t(self, 'comments'))
-		self.threads.append(stream_thread_t(self, 'submissions'))
-		
-		for thread in self.threads:
-			thread.daemon = True
-			thread.start()
-		
+		self.filter = stream_filter_t()
+
+		self.queue = None
+		self.changed = None
+		self.loop = None
+		self.listings = []
+		self.tasks = []
+
+		# id -> task of every object currently being rendered
+		self.in_flight = {}
+
+		# tie breaker so equal priorities come out in FIFO order
+		self.seq = 0
+
+		# Load shedding state, see update_mode()
+		self.degraded = False
+		# seconds the most recently dispatched object spent in the queue
+		self.last_wait = 0
+		# summons put aside while degraded, (priority, backlog, object)
+		self.deferred = []
+
+		# Blocking PRAW requests made on behalf of the ingest coroutines
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='Ingest')
+
+		# Rendering is mostly network bound (pastebin, pob.party, the forums)
+		# so it runs on threads. The XML decode can optionally be pushed
+		# further out to worker processes to get it off the GIL.
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.stream_workers, thread_name_prefix='Render')
+
+		if config.stream_decode_processes > 0:
+			importers.decode_pool = concurrent.futures.ProcessPoolExecutor(max_workers=config.stream_decode_processes)
+
+	def start(self):
+		# Must be called from inside the running event loop, the queue binds
+		# to the loop that creates it.
+		self.loop = asyncio.get_running_loop()
+		self.queue = asyncio.PriorityQueue()
+		self.changed = asyncio.Event()
+
+		self.scheduler = poll_scheduler_t(self)
+		self.tasks.append(asyncio.ensure_future(self.scheduler.run()))
+
+		for type in ('comments', 'submissions'):
+			listing = stream_listing_t(self, type)
+			self.listings.append(listing)
+			self.tasks.append(asyncio.ensure_future(listing.run()))
+
 	def __len__(self):
-		return len(self.list)
-		
+		if self.queue is None:
+			return 0
+
+		return self.queue.qsize() + len(self.in_flight)
+
 	def is_active(self):
-		return len(self) > 0
-		
+		return self.queue is not None and self.queue.qsize() > 0 and len(self.in_flight) < config.stream_workers
+
+	def notify(self):
+		self.changed.set()
+
+	'''
+	Objects are ordered by the time they were queued plus a delay for their
+	class, so an object only ever lets newer objects of a more urgent class
+	jump ahead of it for as long as that delay. Nothing can starve, but a
+	flood of backlog objects after a restart no longer holds up live ones.
+	'''
+	def get_priority(self, object, backlog):
+		delays = config.stream_priority_delays
+
+		if self.filter.is_summon(object):
+			delay = delays['summon']
+		elif isinstance(object, praw.models.Submission):
+			delay = delays['submission']
+		else:
+			delay = delays['comment']
+
+		if backlog:
+			delay += delays['backlog']
+
+		return time.time() + delay
+
+	def put(self, object, priority, backlog=False):
+		self.seq += 1
+		self.queue.put_nowait((priority, self.seq, time.time(), backlog, object))
+		self.notify()
+
+	'''
+	Switches between normal and degraded mode based on how far behind the bot
+	is. Depth is everything waiting in the stream and reply queues, age is
+	the longest any of it has been waiting. Exit thresholds sit below the
+	entry thresholds so the mode doesn't flap.
+
+	While degraded the bot sheds work that is unlikely to matter, see shed().
+	'''
+	def update_mode(self):
+		limits = config.degraded_mode
+
+		depth = self.queue.qsize() + len(self.reply_queue)
+		age = max(self.last_wait, self.reply_queue.get_oldest_age())
+
+		if not self.degraded and ( depth >= limits['enter_depth'] or age >= limits['enter_age'] ):
+			self.degraded = True
+			logging.warning("Entering degraded mode (depth={} age={:.0f}s).".format(depth, age))
+		elif self.degraded and depth <= limits['exit_depth'] and age <= limits['exit_age']:
+			self.degraded = False
+			logging.warning("Leaving degraded mode (depth={} age={:.0f}s), requeueing {} deferred summons.".format(depth, age, len(self.deferred)))
+
+			for priority, backlog, object in self.deferred:
+				self.put(object, priority, backlog)
+
+			self.deferred = []
+
+	# Returns True if the object should not be processed right now
+	def shed(self, priority, backlog, object):
+		limits = config.degraded_mode
+
+		if backlog and time.time() - object.created_utc > limits['backlog_max_age']:
+			logging.info("Degraded mode, skipping backlogged {}.".format(object))
+			self.done(object)
+			return True
+
+		if self.filter.is_summon(object.object) and not self.filter.has_links(object.object):
+			logging.info("Degraded mode, deferring summon {}.".format(object))
+			self.deferred.append((priority, backlog, object))
+			return True
+
+		return False
+
+	async def wait(self, timeout):
+		'''
+		Suspends the caller until an object is queued, an object finishes
+		processing, or timeout elapses.
+		'''
+		self.changed.clear()
+
+		try:
+			await asyncio.wait_for(self.changed.wait(), timeout=timeout)
+		except asyncio.TimeoutError:
+			pass
+
 	def process(self):
+		if self.queue is None:
+			return
+
+		if self.queue.qsize() == 0:
+			self.last_wait = 0
+
+		self.update_mode()
+
+		# hand queued objects to the worker pool while it has room
 		while self.is_active():
-			# pop the first object
-			object = self.list.pop(0)
-			
-			if self.reply_queue.contains_id(object.id):
-				continue
-				
-			if object.author == self.reddit.user.me():
-				logging.debug("{} author is self, ignoring".format(object))
+			# take the most urgent object
+			priority, seq, queued, backlog, object = self.queue.get_nowait()
+			self.last_wait = time.time() - queued
+
+			if self.degraded and self.shed(priority, backlog, object):
 				continue
-						
-			replied = object.parse_and_reply(self.reply_queue)
-			
-			if not replied and object.is_comment() and ( "u/" + config.username ).lower() in object.get_body().lower():
-				reply_to_summon( self.bot, object )
-			
-			
-			
-			
-			
\ No newline at end of file
+
+			logging.debug("Dispatching {} after {:.3f}s in stream queue.".format(object, self.last_wait))
+			self.dispatch(object)
+
+	def dispatch(self, object):
+		if self.reply_queue.contains_id(object.id) or object.id in self.in_flight:
+			self.done(object)
+			return
+
+		self.in_flight[object.id] = asyncio.ensure_future(self.handle(object))
+
+	async def handle(self, object):
+		try:
+			max_importers = config.degraded_mode['max_importers'] if self.degraded else None
+			rendered = await self.loop.run_in_executor(self.pool, self.render, object, max_importers)
+
+			if rendered is not None:
+				self.commit(object, rendered)
+		except asyncio.CancelledError:
+			raise
+		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
+		except BaseException:
+			logging.exception("Fatal error occurred while processing {}.".format(object))
+			os._exit(1)
+			raise
+		finally:
+			del self.in_flight[object.id]
+			self.done(object)
+			self.notify()
+
+	# Called once the manager is finished with an object, whether it was
+	# processed or dropped
+	def done(self, object):
+		pass
+
+	# Runs on a worker thread. Does all of the fetching, parsing and rendering
+	# for an object, but none of the replying.
+	def render(self, object, max_importers=None):
+		if object.author == self.reddit.user.me():
+			logging.debug("{} author is self, ignoring".format(object))
+			return None
+
+		summon = None
+		response, log = object.render(max_importers=max_importers)
+
+		if response is None and object.is_comment() and ( "u/" + config.username ).lower() in object.get_body().lower():
+			summon = render_summon( self.bot, object )
+
+		return response, log, summon
+
+	# Runs on the event loop thread, so commits never interleave with each
+	# other and the dedup checks below are current when the reply is queued.
+	def commit(self, object, rendered):
+		response, log, summon = rendered
+
+		if self.reply_queue.contains_id(object.id) or self.bot.replied_to.contains(object):
+			logging.debug("{} was replied to while it was being processed.".format(object))
+			return
+
+		replied = object.commit(self.reply_queue, response, log)
+
+		if not replied and summon is not None:
+			commit_summon( self.bot, object, summon )
@@ -2,71 +2,188 @@
 import json
 import logging
 import time
+import os
+import threading
 
 # 3rd Party
 import praw
-from atomicwrites import atomic_write
 
 # Self
 import util
+from config import config_helper as config
 from praw_wrapper import praw_object_wrapper_t
+from dedup_set import pack_id
+
+'''
+Everything the bot has replied to, so it never replies twice.
+
+IDs are kept packed into integers, in memory and in the store. The store
+indexes them by time, so when entries expire it says which IDs to drop from
+memory.
+
+Entries expire once nothing can bring their object back around: the backlog
+only reaches back backlog_time_limit, and reddit archives anything older than
+preserve_comments_after so it can't be summoned to either.
+'''
 
 class replied_t:
-	def __init__(self, file_path):
-		self.path = file_path
-	
-		try:
-			with open(file_path, 'r') as f:
-				self.dict = json.load(f)
-		except IOError:
-			self.dict = {}
-			pass
-			
-		logging.debug("Initialized replied to list.")
-		
-	# Takes an id or an object and returns whether that comment/sub in the list
-	def contains(self, obj):
-		id = None
-		
+	# seconds between prunes of expired entries
+	prune_interval = 3600
+
+	def __init__(self, store, legacy_path=None):
+		self.store = store
+		self.ids = set()
+		self.last_prune = 0
+		# replies are added from the reply threads, anything that changes the
+		# IDs or decides to prune holds this
+		self.lock = threading.RLock()
+
+		self.__import_table__()
+
+		if legacy_path is not None:
+			self.__import_legacy__(legacy_path)
+
+		self.prune()
+
+		self.ids.update(row[0] for row in self.store.execute("SELECT id FROM replied"))
+
+		logging.debug("Initialized replied to list with {} entries.".format(len(self)))
+
+	def __len__(self):
+		return len(self.ids)
+
+	# One time import of the json file the list used to be kept in
+	def __import_legacy__(self, path):
+		if not os.path.isfile(path):
+			return
+
+		with self.store.transaction() as conn:
+			if not self.store.is_empty('replied'):
+				return
+
+			with open(path, 'r') as f:
+				d = json.load(f)
+
+			conn.executemany("INSERT OR IGNORE INTO replied (id, submission, time) VALUES (?, ?, ?)", [
+				(pack_id(id), int(e.get('type') == 'submissions'), e.get('time', 0)) for id, e in d.items()
+			])
+
+		logging.info("Imported {} replied to entries from {}.".format(len(d), path))
+
+	# One time import of the table the list was kept in before IDs were packed
+	def __import_table__(self):
+		with self.store.transaction() as conn:
+			if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'replied_to'").fetchone() is None:
+				return
+
+			rows = conn.execute("SELECT id, type, time FROM replied_to").fetchall()
+
+			conn.executemany("INSERT OR IGNORE INTO replied (id, submission, time) VALUES (?, ?, ?)", [
+				(pack_id(id), int(type == 'submissions'), t) for id, type, t in rows
+			])
+			conn.execute("DROP TABLE replied_to")
+
+		logging.info("Packed {} replied to entries.".format(len(rows)))
+
+	@staticmethod
+	def get_expiry():
+		return max(config.backlog_time_limit, config.preserve_comments_after)
+
+	@staticmethod
+	def get_id(obj):
 		if isinstance(obj, str):
-			id = obj
+			return obj
 		elif isinstance(obj, (praw_object_wrapper_t, praw.models.Comment, praw.models.Submission)):
-			id = obj.id
+			return obj.id
 		else:
 			raise ValueError("contains passed bad obj: {}".format(type(obj)))
-			
-		return id in self.dict
-		
-	def flush(self):
-		with atomic_write(self.path, overwrite=True) as f:
-			json.dump(self.dict, f, sort_keys=True, indent=4)
-		
+
+	# Drops expired entries from memory and the store
+	def prune(self):
+		now = time.time()
+		cutoff = now - replied_t.get_expiry()
+		self.last_prune = now
+
+		with self.store.transaction() as conn:
+			expired = [row[0] for row in conn.execute("SELECT id FROM replied WHERE time < ?", (cutoff,))]
+			conn.execute("DELETE FROM replied WHERE time < ?", (cutoff,))
+
+		with self.lock:
+			self.ids.difference_update(expired)
+
+		count = len(expired)
+
+		if count > 0:
+			self.store.compact()
+			logging.info("Pruned {} expired entries from the replied to list.".format(count))
+
+	# Takes an id or an object and returns whether that comment/sub in the list
+	def contains(self, obj):
+		n = pack_id(replied_t.get_id(obj))
+
+		if n in self.ids:
+			return True
+
+		# may have been replied to by another shard
+		return self.store.execute("SELECT 1 FROM replied WHERE id = ?", (n,)).fetchone() is not None
+
+	# Reserve obj for this shard to reply to, see state_store_t.claim
+	def claim(self, obj):
+		return self.store.claim(replied_t.get_id(obj))
+
+	def release(self, obj):
+		self.store.release(replied_t.get_id(obj))
+
 	def add(self, wo):
-		if not isinstance(wo, praw_object_wrapper_t):
-			raise ValueError("add passed bad wo: {}".format(type(wo)))
-			
-		if wo.id in self.dict:
-			logging.warning("add was passed {} whose ID is already listed".format(wo))
-			
-		self.dict[wo.id] = {
-			"id": wo.id,
-			"type": "comments" if wo.is_comment() else "submissions",
-			"time": time.time(),
-		}
-		
-		logging.debug(self.dict[wo.id])
-		
-		logging.debug("Added {} to replied to list.".format(wo))
-		self.flush()
-		
+		self.add_many([wo])
+
+	# Adds several objects in one transaction
+	def add_many(self, wos):
+		now = time.time()
+		rows = []
+
+		for wo in wos:
+			if not isinstance(wo, praw_object_wrapper_t):
+				raise ValueError("add passed bad wo: {}".format(type(wo)))
+
+			n = pack_id(wo.id)
+
+			if n in self.ids:
+				logging.warning("add was passed {} whose ID is already listed".format(wo))
+
+			with self.lock:
+				self.ids.add(n)
+
+			rows.append((n, int(not wo.is_comment()), now))
+
+		with self.store.transaction() as conn:
+			conn.executemany("INSERT OR REPLACE INTO replied (id, submission, time) VALUES (?, ?, ?)", rows)
+			conn.executemany("DELETE FROM claims WHERE id = ?", [(wo.id,) for wo in wos])
+
+		logging.debug("Added {} to replied to list.".format(", ".join(str(wo) for wo in wos)))
+
+		with self.lock:
+			due = now - self.last_prune > replied_t.prune_interval
+
+			# only one thread prunes at a time
+			if due:
+				self.last_prune = now
+
+		if due:
+			self.prune()
+
 	def remove(self, wo):
 		if not isinstance(wo, praw_object_wrapper_t):
 			raise ValueError("remove passed bad wo: {}".format(type(wo)))
-			
-		if wo.id not in self.dict:
+
+		if not self.contains(wo):
 			raise KeyError()
-			
-		del self.dict[wo.id]
-		
+
+		n = pack_id(wo.id)
+
+		with self.lock:
+			self.ids.discard(n)
+
+		self.store.execute("DELETE FROM replied WHERE id = ?", (n,))
+
 		logging.debug("Removed {} from replied to list.".format(wo))
-		self.flush()
\ No newline at end of file
@@ -1,7 +1,9 @@
 # Python
 from collections import deque
+import asyncio
+import concurrent.futures
+import os
 import time
-import math
 import logging
 import json
 
@@ -9,17 +11,42 @@ import json
 import praw
 
 from praw.exceptions import APIException
-from prawcore.exceptions import ServerError
+from prawcore.exceptions import ServerError, Forbidden
 
 # Self
 import util
-from comment_maintenance import maintain_list_t
+from config import config_helper as config
+from comment_maintenance import maintain_list_t, entry_t
 from praw_wrapper import praw_object_wrapper_t
 
 # =============================================================================
 
 class reply_handler_t:
-	_throttled_until = 0
+	'''
+	Queues replies that can't be posted yet and posts them once they can.
+
+	Throttles are kept per (error class, subreddit), e.g. a RATELIMIT in one
+	subreddit doesn't hold back replies to the others. Throttles with no
+	subreddit, such as running out of API requests, apply everywhere. Each one
+	lasts exactly as long as reddit asked for when it says.
+
+	Queued replies are journaled in the state store and replayed on startup,
+	so a restart doesn't lose replies that were already rendered. Replies
+	that have been tried too often, or sat in the journal too long, are
+	dropped instead so a reply that keeps crashing the bot can't do so
+	forever.
+
+	Replies are posted concurrently from the event loop, up to
+	reply_concurrency at a time and never more than the rate limit has
+	requests left for. The bookkeeping for replies that went through is
+	batched, see flush().
+	'''
+
+	# seconds to back off for errors that don't say how long to wait
+	default_throttle = 60
+	
+	# errors that mean the reply can never be posted
+	final_errors = ('DELETED_COMMENT', 'TOO_OLD', 'THREAD_LOCKED', 'SUBREDDIT_NOTALLOWED', 'SUBREDDIT_NOEXIST')
 
 	def __init__(self, bot):
 		self.bot = bot
@@ -27,35 +54,147 @@ class reply_handler_t:
 		self.replied_to = bot.replied_to
 		self.queue_dict = {}
 		self.queue = deque()
+		# (error class, subreddit or None) -> time the throttle lifts
+		self.throttles = {}
 		
-	def reply(self, object, message_body, log = True):
+		# replies currently being posted
+		self.in_flight = set()
+		# (comment, fingerprint) of replies that went through and need
+		# maintaining, but haven't been flushed yet
+		self.posted = []
+		self.flush_scheduled = False
+		
+		# Blocking PRAW and store calls made while posting
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.reply_concurrency, thread_name_prefix='Reply')
+		
+		self.replay()
+		
+	# subreddit and fingerprint save looking them up on object, which may not
+	# be loaded yet
+	def reply(self, object, message_body, log = True, subreddit = None, fingerprint = None):
 		if not isinstance(object, praw_object_wrapper_t):
 			raise ValueError("reply was passed an invalid object: {}".format(type(object)))
 		
-		rep = reply_t( self, object, message_body, log )
+		rep = reply_t( self, object, message_body, log, subreddit=subreddit, fingerprint=fingerprint )
 		
-		if self.throttled():
-			self.append( rep )
-			logging.info("Added response to {} to reply queue.".format(rep.object))
-		else:
-			rep.attempt_post()
-			
-			if not rep.resolved:
-				self.append( rep )
-				logging.info("Reply failed. Added response to {} to reply queue.".format(rep.object))
+		self.append( rep )
+		logging.info("Added response to {} to reply queue.".format(rep.object))
 				
-	def throttled(self):
-		return reply_handler_t._throttled_until > time.time()
+	def throttle(self, error, subreddit, duration):
+		key = (error, subreddit)
+		until = time.time() + duration
 		
-	def throttled_for(self):
-		return math.max(0, reply_handler_t._throttled_until - time.time() )
+		self.throttles[key] = max(self.throttles.get(key, 0), until)
+		
+		logging.warning("Throttled {} replies{} for {:.0f}s.".format(
+			error,
+			" in r/{}".format(subreddit) if subreddit is not None else "",
+			duration
+		))
+		
+	# Throttles from the x-ratelimit-* headers of the last response, as the
+	# rate budget saw them
+	def check_limits(self):
+		budget = self.bot.budget
+		
+		if budget.remaining is not None and budget.remaining < 1 and budget.reset_timestamp is not None:
+			self.throttle('ratelimit headers', None, budget.reset_timestamp - time.time())
+		
+	# Time at which replies to subreddit can next be posted. Without a
+	# subreddit, only throttles that apply everywhere are considered.
+	def get_available_time(self, subreddit=None):
+		now = time.time()
+		t = 0
+		
+		for (error, s), until in list(self.throttles.items()):
+			if until <= now:
+				del self.throttles[(error, s)]
+			elif s is None or s == subreddit:
+				t = max(t, until)
+				
+		return t
+		
+	def throttled(self, subreddit=None):
+		return self.get_available_time(subreddit) > time.time()
+		
+	def throttled_for(self, subreddit=None):
+		return max(0, self.get_available_time(subreddit) - time.time() )
 	
+	# Earliest time any queued reply can be posted
 	def throttled_until(self):
-		return reply_handler_t._throttled_until
+		waiting = self.get_waiting()
+		
+		if len(waiting) == 0:
+			return 0
 			
-	def append(self, rep):
+		return min(self.get_available_time(s) for s in set(rep.subreddit for rep in waiting))
+		
+	# Replies that are neither being posted nor done
+	def get_waiting(self):
+		return [rep for rep in self.queue if not rep.resolved and rep not in self.in_flight]
+		
+	# Number of replies that may be posted at once right now
+	def get_limit(self):
+		limit = config.reply_concurrency
+		remaining = self.bot.budget.remaining
+		
+		if remaining is not None:
+			limit = min(limit, max(int(remaining), 1))
+			
+		return limit
+		
+	# Whether there are replies that could be posted as soon as their
+	# throttles lift. While every slot is taken the caller can sleep until
+	# a post completes instead.
+	def is_pending(self):
+		return len(self.in_flight) < self.get_limit() and len(self.get_waiting()) > 0
+			
+	def replay(self):
+		rows = self.bot.store.execute("SELECT id, fullname, subreddit, body, log, created, attempts, fingerprint FROM reply_journal WHERE shard = ? ORDER BY created", (self.bot.store.shard,)).fetchall()
+		replayed = 0
+		
+		for id, fullname, subreddit, body, log, created, attempts, fingerprint in rows:
+			if reply_handler_t.is_expired(created, attempts):
+				logging.warning("Dropping reply to {} from the reply journal after {} attempts.".format(fullname, attempts))
+				self.bot.store.execute("DELETE FROM reply_journal WHERE id = ?", (id,))
+				self.replied_to.release(id)
+				continue
+				
+			object = praw_object_wrapper_t(self.bot, util.get_praw_object_by_fullname(self.bot.reddit, fullname))
+			
+			rep = reply_t( self, object, body, bool(log), subreddit=subreddit, fingerprint=fingerprint )
+			rep.created = created
+			rep.attempts = attempts
+			
+			self.append( rep, journal=False )
+			replayed += 1
+			
+		if replayed > 0:
+			logging.info("Replayed {} replies from the reply journal.".format(replayed))
+			
+	# Whether a reply has been tried too often or waited too long to keep
+	# trying
+	@staticmethod
+	def is_expired(created, attempts):
+		limits = config.reply_journal
+		
+		return attempts >= limits['max_attempts'] or time.time() - created >= limits['max_age']
+		
+	def append(self, rep, journal=True):
 		self.queue.append( rep )
 		
+		if journal:
+			self.bot.store.execute("INSERT OR REPLACE INTO reply_journal (id, fullname, subreddit, body, log, created, shard, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+				rep.object.id,
+				rep.object.fullname,
+				rep.subreddit,
+				rep.message_body,
+				int(rep.req_maintenance),
+				rep.created,
+				self.bot.store.shard,
+				rep.fingerprint,
+			))
+		
 		if rep.object.id in self.queue_dict:
 			self.queue_dict[ rep.object.id ] += 1
 		else:
@@ -67,23 +206,108 @@ class reply_handler_t:
 	def __len__(self):
 		return len(self.queue)
 		
+	# Seconds the oldest reply that could be posted right now has been
+	# waiting. Replies that are done, or held back by a throttle, are waiting
+	# on reddit rather than on the bot and don't count.
+	def get_oldest_age(self):
+		now = time.time()
+		ages = [now - rep.created for rep in self.queue if not rep.resolved and not self.throttled(rep.subreddit)]
+		
+		return max(ages) if len(ages) > 0 else 0
+		
 	def is_active(self):
-		return len(self.queue) > 0 and not self.throttled()
+		return self.is_pending() and time.time() >= self.throttled_until()
 				
+	# Must be called from the event loop
 	def process(self):
-		while self.is_active():
-			logging.debug("Processing reply queue entry (of {})".format( len(self) ))
-			self.queue[0].attempt_post()
+		if not self.is_active():
+			return
+			
+		limit = self.get_limit()
+		
+		# Replies are started in the order they were queued, skipping any
+		# that are still throttled
+		for rep in self.get_waiting():
+			if len(self.in_flight) >= limit:
+				break
+				
+			if self.throttled(rep.subreddit):
+				continue
+				
+			logging.debug("Posting reply queue entry (of {})".format( len(self) ))
+			self.in_flight.add( rep )
+			asyncio.ensure_future(self.post( rep ))
+			
+	async def post(self, rep):
+		try:
+			await rep.attempt_post()
+		except asyncio.CancelledError:
+			raise
+		# If ANY unhandled exception occurs, catch it, log it, THEN crash.
+		except BaseException:
+			logging.exception("Fatal error occurred while posting reply to {}.".format(rep.object))
+			os._exit(1)
+			raise
+		finally:
+			self.in_flight.discard( rep )
 			
-			if self.queue[0].resolved:
-				rep = self.queue.popleft()
-				self.queue_dict[ rep.object.id ] -= 1
+			# batch up the bookkeeping for a burst of replies. The last one of a
+			# burst flushes whatever the others posted, even if it failed itself.
+			if len(self.in_flight) == 0:
+				if rep.resolved or len(self.posted) > 0:
+					self.schedule_flush()
+			elif len(self.posted) >= config.reply_concurrency:
+				self.schedule_flush()
 				
-				if self.queue_dict[ rep.object.id ] <= 0:
-					del self.queue_dict[ rep.object.id ];
+			self.bot.stream_manager.notify()
+			
+	# Replies that need maintaining are added to the maintenance list in
+	# batches, replied_to is updated as each one is posted
+	def add_posted(self, comment, fingerprint):
+		if comment is not None:
+			self.posted.append( (comment, fingerprint) )
+		
+	def schedule_flush(self):
+		# Posts that complete around the same time share one flush
+		if not self.flush_scheduled:
+			self.flush_scheduled = True
+			asyncio.get_running_loop().call_soon(self.flush)
+			
+	def flush(self):
+		'''
+		Adds every reply that went through since the last flush to the
+		maintenance list in one go, then drops resolved replies from the queue
+		and the journal. Posted replies were already recorded and taken out of
+		the journal by reply_t.post().
+		'''
+		self.flush_scheduled = False
+		
+		posted = self.posted
+		self.posted = []
+		
+		if len(posted) > 0:
+			self.maintain_list.add_many( posted )
+				
+		resolved = [rep for rep in self.queue if rep.resolved]
+		
+		if len(resolved) == 0:
+			return
+			
+		done = []
+		
+		for rep in resolved:
+			self.queue_dict[ rep.object.id ] -= 1
+			
+			if self.queue_dict[ rep.object.id ] <= 0:
+				del self.queue_dict[ rep.object.id ];
+				done.append( (rep.object.id,) )
+				
+		self.bot.store.conn.executemany("DELETE FROM reply_journal WHERE id = ?", done)
+		
+		self.queue = deque(rep for rep in self.queue if not rep.resolved)
 		
 class reply_t:
-	def __init__(self, handler, object, message_body, log):
+	def __init__(self, handler, object, message_body, log, subreddit=None, fingerprint=None):
 		if not isinstance(object, praw_object_wrapper_t):
 			raise ValueError("init was passed an invalid object: {}".format(type(object)))
 			
@@ -92,36 +316,109 @@ class reply_t:
 		self.message_body = message_body
 		self.req_maintenance = log
 		self.resolved = False
+		self.created = time.time()
+		self.attempts = 0
+		self.subreddit = subreddit if subreddit is not None else str(object.subreddit).lower()
+		# what the reply was rendered from, see entry_t.get_fingerprint()
+		self.fingerprint = fingerprint
+		
+	async def call(self, func, *args):
+		return await asyncio.get_running_loop().run_in_executor(self.handler.executor, func, *args)
 		
-	def attempt_post( self ):
+	async def attempt_post( self ):
 		if self.resolved:
 			return
+			
+		if reply_handler_t.is_expired(self.created, self.attempts):
+			logging.warning("Giving up on replying to {} after {} attempts. Removing response from reply queue.".format(self.object, self.attempts))
+			await self.give_up()
+			return
+			
+		# shards share an account, make sure only one of them replies
+		if not await self.call(self.handler.replied_to.claim, self.object):
+			logging.warning("{} has already been replied to by another shard. Removing response from reply queue.".format(self.object))
+			self.resolved = True
+			return
 	
 		try:
-			comment = self.object.reply( self.message_body )
+			await self.handler.bot.budget.wait('reply')
+			
+			# counted before posting, so an attempt that crashes the bot counts
+			# towards the limit when the journal is replayed
+			self.attempts += 1
+			await self.call(self.handler.bot.store.execute, "UPDATE reply_journal SET attempts = ? WHERE id = ?", (self.attempts, self.object.id))
+			
+			comment = await self.call(self.post)
 			
 			logging.info("Replied to {} with {}.".format(self.object, comment))
 	
-			self.handler.replied_to.add(self.object)
-			
 			if self.req_maintenance:
-				self.handler.maintain_list.add( comment )
+				self.handler.add_posted(comment, self.fingerprint)
 				
 			self.resolved = True
 		except APIException as e:
-			if "DELETED_COMMENT" in str(e):
-				self.resolved = True
+			errors = set(getattr(item, 'error_type', None) for item in getattr(e, 'items', None) or [e])
+			
+			if "DELETED_COMMENT" in errors:
 				logging.warning("Parent {} has been deleted before it could be responded to. Removing response from reply queue.".format(self.object))
-			elif "TOO_OLD" in str(e):
-				self.resolved = True
+				await self.give_up()
+			elif "TOO_OLD" in errors:
 				logging.warning("Ignoring {} as it is too old to be responded to.".format(self.object))
+				await self.give_up()
+			elif not errors.isdisjoint(reply_handler_t.final_errors):
+				logging.warning("Can't reply to {} ({}). Removing response from reply queue.".format(self.object, repr(e)))
+				await self.give_up()
 			else:
 				logging.warning("Failed to reply {}, buffering reply for later.".format(repr(e)))
-				reply_handler_t._throttled_until = time.time() + 60
+				self.throttle(e)
 				
 				self.resolved = False
+		except Forbidden:
+			# banned from the subreddit, or the parent is somewhere the bot
+			# can't see anymore
+			logging.warning("Forbidden from replying to {}. Removing response from reply queue.".format(self.object))
+			await self.give_up()
 		except ServerError as e:
 			logging.error("{} occurred while attempting to post response to {}. Stack trace dumped.".format(e, self.object))
 			logging.debug(self.object.permalink)
 			logging.debug(e, exc_info=True)
-			self.resolved = False
\ No newline at end of file
+			self.resolved = False
+			
+		self.handler.check_limits()
+		
+	# Runs on a reply thread. The reply is recorded as soon as it's posted,
+	# a crash before that is recorded would post it again from the journal.
+	def post(self):
+		# Replies queued without a fingerprint are fingerprinted before they're
+		# posted, so a parent that fails to load fails the attempt rather than
+		# the bookkeeping after it. Unless the reply was replayed, the parent
+		# is already loaded.
+		if self.req_maintenance and self.fingerprint is None:
+			self.fingerprint = entry_t.get_fingerprint(self.object)
+			
+		comment = self.object.reply(self.message_body)
+		
+		self.handler.replied_to.add(self.object)
+		self.handler.bot.store.execute("DELETE FROM reply_journal WHERE id = ?", (self.object.id,))
+		
+		return comment
+		
+	# Resolves a reply that will never be posted. flush() takes it out of the
+	# queue and the journal.
+	async def give_up(self):
+		self.resolved = True
+		await self.call(self.handler.replied_to.release, self.object)
+		
+	def throttle(self, e):
+		# PRAW 7 bundles every error in the response into one exception
+		for item in getattr(e, 'items', None) or [e]:
+			error = getattr(item, 'error_type', None) or 'APIException'
+			duration = None
+			
+			if error == 'RATELIMIT':
+				duration = util.parse_ratelimit(getattr(item, 'message', None))
+				
+			if duration is None:
+				duration = reply_handler_t.default_throttle
+				
+			self.handler.throttle(error, self.subreddit, duration)
\ No newline at end of file
@@ -1,8 +1,8 @@
 # Python
-import re
 import os
 import traceback
 import logging
+import itertools
 
 # 3rd Party
 import urllib.request, urllib.error, urllib.parse
@@ -10,8 +10,7 @@ import praw
 
 # Self
 import util
-from importers import Pastebin
-from importers import PoBParty
+from importers import find_importers
 from config import config_helper as config
 import comment_maintenance
 from praw_wrapper import praw_object_wrapper_t
@@ -22,18 +21,9 @@ from _exceptions import ImporterLimitException
 
 # =============================================================================
 
-def find_importers(body):
-	for match in re.finditer('pastebin\.com/\w+', body):
-		bin = "https://" + match.group(0)
-		yield Pastebin(url=bin)
-
-	for match in re.finditer('pob\.party/share/\w+', body):
-		url = "https://" + match.group(0)
-		yield PoBParty(url=url)
-
-# =============================================================================
-
-def get_response( wrapped_object, ignore_blacklist=False ):
+# max_importers caps how many importers are fetched, the stream lowers it while
+# the bot is shedding load.
+def get_response( wrapped_object, ignore_blacklist=False, max_importers=None ):
 	if not (wrapped_object is not None and isinstance( wrapped_object, praw_object_wrapper_t )):
 		raise ValueError("get_response was passed an invalid wrapped_object: {}".type(wrapped_object))
 		
@@ -46,7 +36,7 @@ def get_response( wrapped_object, ignore_blacklist=False ):
 		responses = []
 		importers_responded_to = {}
 	
-		for importer in find_importers(body):
+		for importer in itertools.islice(find_importers(body), max_importers):
 			if (not importer.is_blacklisted() or ignore_blacklist):
 				if importer.key not in importers_responded_to:
 					if importer.is_pob_xml():
@@ -100,6 +90,14 @@ def get_response( wrapped_object, ignore_blacklist=False ):
 		logging.debug("{} includes no pastebins.".format(wrapped_object))
 			
 def reply_to_summon(bot, comment, ignore_blacklist=False):
+	rendered = render_summon(bot, comment, ignore_blacklist=ignore_blacklist)
+	
+	if rendered is not None:
+		commit_summon(bot, comment, rendered)
+	
+# Does the network and parsing half of reply_to_summon, safe to run on a
+# worker thread. Returns None if there is nothing to reply with.
+def render_summon(bot, comment, ignore_blacklist=False):
 	if not isinstance(comment, praw_object_wrapper_t):
 		raise ValueError("reply_to_summon was passed an invalid comment: {}".format(type(comment)))
 
@@ -109,7 +107,7 @@ def reply_to_summon(bot, comment, ignore_blacklist=False):
 	logging.debug("Comment {} summons {}, parent is comment {}.".format(comment.id, config.username, parent.id))
 	
 	if parent.author == bot.reddit.user.me():
-		return
+		return None
 		
 	p_response = None
 	
@@ -118,6 +116,13 @@ def reply_to_summon(bot, comment, ignore_blacklist=False):
 			p_response = get_response( parent, ignore_blacklist = True )
 	except (EligibilityException, ImporterLimitException) as e:
 		errs.append("* {}".format(str(e)))
+		
+	return parent, p_response, errs
+	
+# Posts the replies for a rendered summon. The replied_to and reply queue
+# checks happen here so they can't race with another object's replies.
+def commit_summon(bot, comment, rendered):
+	parent, p_response, errs = rendered
 	
 	response = None
 		
@@ -139,8 +144,4 @@ def reply_to_summon(bot, comment, ignore_blacklist=False):
 		return
 	
 	if config.username == "PoBPreviewBot" or "pathofexile" not in config.subreddits:
-		bot.reply_queue.reply(comment, response, log = False)
-		
-		
-		
-		
\ No newline at end of file
+		bot.reply_queue.reply(comment, response, log = False)
\ No newline at end of file
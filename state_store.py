@@ -0,0 +1,230 @@
+# Python
+import sqlite3
+import threading
+import logging
+import time
+import os
+
+# 3rd Party
+# Self
+from dedup_set import pack_id
+
+# =============================================================================
+
+'''
+Local state shared between bot processes.
+
+Each shard runs as its own process with its own set of subreddits, but they
+all reply as the same account, so the replied to list, the maintenance list
+and the importer blacklists live in one SQLite database that every shard
+opens. SQLite's own file locking serializes writers across processes, and
+WAL mode lets readers carry on while a write is in progress.
+
+A single process is simply shard 0 of 1.
+'''
+
+schema = """
+CREATE TABLE IF NOT EXISTS replied (
+	id INTEGER PRIMARY KEY,
+	submission INTEGER NOT NULL,
+	time REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS replied_time ON replied (time);
+
+CREATE TABLE IF NOT EXISTS claims (
+	id TEXT PRIMARY KEY,
+	shard INTEGER NOT NULL,
+	time REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS maintain_list (
+	comment_id TEXT PRIMARY KEY,
+	created_utc INTEGER NOT NULL,
+	last_time INTEGER NOT NULL,
+	owner INTEGER NOT NULL,
+	parent_id TEXT,
+	fingerprint TEXT
+);
+
+CREATE INDEX IF NOT EXISTS maintain_list_owner ON maintain_list (owner);
+
+CREATE TABLE IF NOT EXISTS maintain_archive (
+	comment_id TEXT PRIMARY KEY,
+	created_utc INTEGER NOT NULL,
+	parent_id TEXT,
+	owner INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS maintain_archive_created ON maintain_archive (created_utc);
+
+CREATE TABLE IF NOT EXISTS reply_shadow (
+	comment_id TEXT PRIMARY KEY,
+	hash TEXT NOT NULL,
+	body BLOB NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS maintain_events (
+	time REAL NOT NULL,
+	comment_id TEXT NOT NULL,
+	subreddit TEXT,
+	author TEXT,
+	from_age REAL NOT NULL,
+	to_age REAL NOT NULL,
+	kind TEXT NOT NULL,
+	event_age REAL
+);
+
+CREATE INDEX IF NOT EXISTS maintain_events_time ON maintain_events (time);
+
+CREATE TABLE IF NOT EXISTS maintain_stats (
+	day INTEGER NOT NULL,
+	bin INTEGER NOT NULL,
+	subreddit TEXT NOT NULL,
+	author TEXT NOT NULL,
+	exposure REAL NOT NULL,
+	events INTEGER NOT NULL,
+	PRIMARY KEY (day, bin, subreddit, author)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS queue (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	name TEXT NOT NULL,
+	key TEXT,
+	payload TEXT NOT NULL,
+	priority REAL NOT NULL,
+	lease_until REAL NOT NULL DEFAULT 0,
+	attempts INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS queue_order ON queue (name, priority, id);
+CREATE INDEX IF NOT EXISTS queue_key ON queue (name, key);
+
+CREATE TABLE IF NOT EXISTS reply_journal (
+	id TEXT PRIMARY KEY,
+	fullname TEXT NOT NULL,
+	subreddit TEXT NOT NULL,
+	body TEXT NOT NULL,
+	log INTEGER NOT NULL,
+	created REAL NOT NULL,
+	shard INTEGER NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	fingerprint TEXT
+);
+
+CREATE TABLE IF NOT EXISTS blacklist (
+	kind TEXT NOT NULL,
+	key TEXT NOT NULL,
+	PRIMARY KEY (kind, key)
+);
+"""
+
+class state_store_t:
+	# claims older than this were left behind by a shard that crashed
+	claim_timeout = 86400
+
+	def __init__(self, path, shard=0, shards=1):
+		if not 0 <= shard < shards:
+			raise ValueError("invalid shard {}/{}".format(shard, shards))
+
+		self.path = path
+		self.shard = shard
+		self.shards = shards
+
+		# sqlite connections can't be shared between threads
+		self.local = threading.local()
+
+		dir = os.path.dirname(path)
+
+		if dir and not os.path.exists(dir):
+			os.makedirs(dir)
+
+		self.conn.executescript(schema)
+
+		# columns added since the table was first created
+		self.add_column('maintain_list', 'parent_id', 'TEXT')
+		self.add_column('maintain_list', 'fingerprint', 'TEXT')
+		self.add_column('reply_journal', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+		self.add_column('reply_journal', 'fingerprint', 'TEXT')
+
+		logging.debug("Opened state store {} as shard {}/{}.".format(path, shard, shards))
+
+	@property
+	def conn(self):
+		if not hasattr(self.local, 'conn'):
+			# autocommit mode, transactions are opened explicitly
+			conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=NORMAL")
+			self.local.conn = conn
+
+		return self.local.conn
+
+	def add_column(self, table, column, type):
+		with self.transaction() as conn:
+			columns = [row[1] for row in conn.execute("PRAGMA table_info({})".format(table))]
+
+			if column not in columns:
+				conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, type))
+
+	def execute(self, sql, args=()):
+		return self.conn.execute(sql, args)
+
+	def transaction(self):
+		return transaction_t(self.conn)
+
+	# Entries belong to the shard that created them. Entries without a valid
+	# owner (imported, or left by a shard that no longer exists after the
+	# shard count changed) are spread over the shards by ID.
+	def is_owner(self, id, owner):
+		if 0 <= owner < self.shards:
+			return owner == self.shard
+
+		return int(id, 36) % self.shards == self.shard
+
+	# Writes go to the WAL, which SQLite otherwise only folds back into the
+	# database in small steps. Folding it in and truncating it after a large
+	# delete keeps the files from holding on to the space.
+	def compact(self):
+		self.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+	def is_empty(self, table):
+		return self.execute("SELECT 1 FROM {} LIMIT 1".format(table)).fetchone() is None
+
+	# Claim the right to reply to an object. Returns False if it has already
+	# been replied to, or if another shard is in the middle of replying to it.
+	def claim(self, id):
+		now = time.time()
+
+		with self.transaction() as conn:
+			if conn.execute("SELECT 1 FROM replied WHERE id = ?", (pack_id(id),)).fetchone() is not None:
+				return False
+
+			conn.execute("DELETE FROM claims WHERE id = ? AND time < ?", (id, now - state_store_t.claim_timeout))
+			conn.execute("INSERT OR IGNORE INTO claims (id, shard, time) VALUES (?, ?, ?)", (id, self.shard, now))
+
+			row = conn.execute("SELECT shard FROM claims WHERE id = ?", (id,)).fetchone()
+
+		return row[0] == self.shard
+
+	def release(self, id):
+		self.execute("DELETE FROM claims WHERE id = ? AND shard = ?", (id, self.shard))
+
+class transaction_t:
+	'''
+	BEGIN IMMEDIATE takes the write lock up front, so a transaction that reads
+	before it writes can't be invalidated by another process in between.
+	'''
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def __enter__(self):
+		self.conn.execute("BEGIN IMMEDIATE")
+		return self.conn
+
+	def __exit__(self, type, value, traceback):
+		if type is None:
+			self.conn.execute("COMMIT")
+		else:
+			self.conn.execute("ROLLBACK")
@@ -10,16 +10,26 @@ from atomicwrites import atomic_write
 
 # Self
 import util
+from config import config_helper as config
 
 file = 'status.json'
 status = {}
+last_write = 0
 
 def update():
+	global last_write
+	
 	status['lastUpdate'] = time.time()
+	
+	# written on a schedule, the stream checkpoints change with every object
+	if status['lastUpdate'] - last_write < config.stream_checkpoint_interval:
+		return
 
 	with atomic_write(file, overwrite=True) as f:
 		json.dump(status, f, sort_keys=True, indent=4)
 		
+	last_write = status['lastUpdate']
+		
 	logging.debug("lastUpdate set to [{}].".format(datetime.datetime.fromtimestamp(status['lastUpdate'])))
 		
 def get_last_update():
@@ -29,7 +39,42 @@ def get_last_update():
 		logging.warning("Could not find lastUpdate in status: {}".format(status))
 		return 0
 	
-def init():	
+# The checkpoint is the newest object a stream listing has handed off, only
+# persisted by update() which is only called once everything it handed off has
+# been processed.
+def get_checkpoint(type):
+	try:
+		return status['checkpoints'][type]
+	except KeyError:
+		return None
+		
+def set_checkpoint(type, fullname, created_utc):
+	if 'checkpoints' not in status:
+		status['checkpoints'] = {}
+		
+	status['checkpoints'][type] = {
+		'fullname': fullname,
+		'created_utc': created_utc,
+	}
+	
+# Smoothed post rates by hour of day of a stream listing, so the poll
+# scheduler doesn't have to relearn them after a restart.
+def get_poll_rates(type):
+	try:
+		return status['pollRates'][type]
+	except KeyError:
+		return None
+		
+def set_poll_rates(type, rates):
+	if 'pollRates' not in status:
+		status['pollRates'] = {}
+		
+	status['pollRates'][type] = rates
+	
+def init(path='status.json'):
+	global file
+	file = path
+	
 	if os.path.exists(file):
 		with open(file, 'r') as f:
 			global status
@@ -8,6 +8,7 @@ import os
 
 # 3rd Party
 import praw
+import requests
 import progressbar
 
 # Self
@@ -18,7 +19,10 @@ import response
 import util
 import stat_parsing
 import item
+import importers
 from importers import ImporterEncoder, Pastebin, PoBParty
+from state_store import state_store_t
+from rate_budget import rate_budget_t
 import profile_tools
 from profile_tools import profile_cumulative, profile, ChunkProfiler
 from pob_build import build_t
@@ -30,6 +34,8 @@ logging.root.setLevel(logging.INFO)
 class unit_tester_t:
 	def __init__(self):
 		self.login()
+		self.store = state_store_t("save/unit_test.db")
+		importers.store = self.store
 		self.replied_to = None
 		self.acm_event = threading.Event()
 		self.maintain = comment_maintenance.maintain_list_t(self, "save/active_comments.json.server")
@@ -44,11 +50,18 @@ class unit_tester_t:
 		if config.username == '[redacted]':
 			raise ValueError("settings_secret.json is not valid.")
 		
+		self.budget = rate_budget_t()
+		self.budget.start()
+		
+		session = requests.Session()
+		session.hooks['response'].append(self.budget)
+		
 		r = praw.Reddit(username = config.username,
 			password = config.password,
 			client_id = config.client_id,
 			client_secret = config.client_secret,
-			user_agent = "linux:PoBPreviewBot-UnitTest:v1.0 (by /u/aggixx)")
+			user_agent = "linux:PoBPreviewBot-UnitTest:v1.0 (by /u/aggixx)",
+			requestor_kwargs = {'session': session})
 			
 		logging.info("Successfully logged in as {:s}.".format(config.username))
 			
@@ -7,6 +7,8 @@ import xml.etree.ElementTree as ET
 from datetime import datetime
 import logging
 import threading
+import time
+import math
 
 # 3rd Party
 import urllib.request, urllib.error, urllib.parse
@@ -88,6 +90,48 @@ def parse_time_str(str):
 	else:
 		raise Exception("time_str did not follow XdXhXm format.")
 	
+# Parses the optional "-shard i/N" argument, defaulting to a single process.
+def parse_shard(args):
+	if '-shard' not in args:
+		return 0, 1
+		
+	mo = re.match("^(\d+)/(\d+)$", args[ args.index('-shard') + 1 ])
+	
+	if not mo or not 0 <= int(mo.group(1)) < int(mo.group(2)):
+		raise ValueError("-shard expects i/N with 0 <= i < N")
+		
+	return int(mo.group(1)), int(mo.group(2))
+	
+# Parses the optional "-pipeline <stage>" argument, see pipeline.py. Defaults
+# to running every stage in one process.
+def parse_pipeline(args, stages):
+	if '-pipeline' not in args:
+		return 'all'
+		
+	stage = args[ args.index('-pipeline') + 1 ]
+	
+	if stage not in stages:
+		raise ValueError("-pipeline expects one of {}".format(", ".join(stages)))
+		
+	return stage
+	
+# Parses the wait out of a RATELIMIT error message, e.g. "Take a break for 7
+# seconds before trying again." Returns seconds, or None if there isn't one.
+def parse_ratelimit(message):
+	mo = re.search("(\d+) (millisecond|second|minute|hour)s?", message or "")
+	
+	if not mo:
+		return None
+		
+	units = {
+		'millisecond': 0.001,
+		'second': 1,
+		'minute': 60,
+		'hour': 3600,
+	}
+	
+	return int(mo.group(1)) * units[mo.group(2)]
+	
 praw_errors = (RequestException, ServerError, APIException, ResponseException)
 	
 def is_praw_error(e):
@@ -111,6 +155,16 @@ def praw_error_retry(attempt_number, ms_since_first_attempt):
 def get_praw_comment_by_id(reddit, id):
 	return praw.models.Comment(reddit, id=id)
 		
+# Lazy comment or submission for a fullname, nothing is fetched until an
+# attribute is needed
+def get_praw_object_by_fullname(reddit, fullname):
+	if fullname.startswith('t1_'):
+		return praw.models.Comment(reddit, id=fullname[3:])
+	elif fullname.startswith('t3_'):
+		return praw.models.Submission(reddit, id=fullname[3:])
+	else:
+		raise ValueError("unexpected fullname {}".format(fullname))
+		
 def is_number(s):
 	try:
 		float(s)
@@ -195,3 +249,86 @@ def dump_debug_info(praw_object, exc=None, paste_key=None, xml=None, extra_data=
 			traceback.print_exc( file = f )
 	
 	logging.info("Dumped info to {}/{}/".format(dir, id))
+
+class timed_lock_t:
+	'''
+	Reentrant lock that keeps histograms of how long it was waited for and
+	held, counting only the outermost acquisition of each thread. Bucket i
+	counts times under 2^i ms, the last bucket everything longer.
+	'''
+
+	buckets = 14
+
+	def __init__(self, name):
+		self.name = name
+		self.lock = threading.RLock()
+		self.local = threading.local()
+		self.waits = [0] * timed_lock_t.buckets
+		self.holds = [0] * timed_lock_t.buckets
+		self.max_hold = 0
+
+	def __str__(self):
+		return "{} lock held {}, max {:.3f}s; waited for {}".format(
+			self.name,
+			timed_lock_t.format_histogram(self.holds),
+			self.max_hold,
+			timed_lock_t.format_histogram(self.waits)
+		)
+
+	@staticmethod
+	def get_bucket(seconds):
+		ms = seconds * 1000
+
+		if ms < 1:
+			return 0
+
+		return min(int(math.log2(ms)) + 1, timed_lock_t.buckets - 1)
+
+	@staticmethod
+	def format_histogram(counts):
+		parts = []
+
+		for i, n in enumerate(counts):
+			if n == 0:
+				continue
+
+			if i < len(counts) - 1:
+				parts.append("<{}ms: {}".format(2 ** i, n))
+			else:
+				parts.append(">={}ms: {}".format(2 ** (i - 1), n))
+
+		return "[{}]".format(", ".join(parts))
+
+	def acquire(self, blocking=True, timeout=-1):
+		start = time.perf_counter()
+
+		if not self.lock.acquire(blocking, timeout):
+			return False
+
+		depth = getattr(self.local, 'depth', 0)
+
+		# the histograms are only touched while the lock is held
+		if depth == 0:
+			self.local.start = time.perf_counter()
+			self.waits[timed_lock_t.get_bucket(self.local.start - start)] += 1
+
+		self.local.depth = depth + 1
+
+		return True
+
+	def release(self):
+		self.local.depth -= 1
+
+		if self.local.depth == 0:
+			held = time.perf_counter() - self.local.start
+			self.holds[timed_lock_t.get_bucket(held)] += 1
+			self.max_hold = max(self.max_hold, held)
+
+		self.lock.release()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.release()